@@ -6,15 +6,26 @@ import argparse
 import numpy as np
 import numba as nb
 import pandas as pd
+import h5py
 
 from dask.callbacks import Callback
 from tqdm.auto import tqdm
 
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 # import matplotlib.pyplot as plt
 
 INVALID_ADC_VALUE = 65535 #essentially -1 for uint16
 LST_FILE_APPROX_CHUNK = 50_000_000
 TYPICAL_DASK_CHUNK = 300_000
+EVENT_CHUNK = TYPICAL_DASK_CHUNK//4 # Dask blocks cover whole HDF5 chunks, which fit the default chunk cache
+EVENT_COMPRESSIONS = ["none", "lzf", "gzip", "blosc"]
+DEFAULT_EVENT_COMPRESSION = "lzf" # Built into h5py, blosc files need hdf5plugin to be read
+DENSE_MAX_BINS = 1 << 24 # Larger histograms are accumulated sparse
+SPARSE_MAX_FILL = 0.25 # Histograms with fewer non-empty bins are stored sparse
 
 PLOT_LABEL_ADC_TO_PHYS = {
     "ADC1":r"$E_\gamma$ (eV)",
@@ -69,6 +80,130 @@ default_argparser.add_argument(
     type=str,
 )
 
+event_layout_argparser = argparse.ArgumentParser(add_help=False)
+event_layout_argparser.add_argument(
+    "--compression",
+    help="Compression filter for event datasets, blosc requires the hdf5plugin package.",
+    choices=EVENT_COMPRESSIONS,
+    default=DEFAULT_EVENT_COMPRESSION
+)
+event_layout_argparser.add_argument(
+    "--compression-level",
+    help="Compression level for gzip (0-9) and blosc (0-9).",
+    type=int,
+)
+event_layout_argparser.add_argument(
+    "--no-shuffle",
+    help="Do not apply the byte shuffle filter before compression.",
+    action="store_true"
+)
+event_layout_argparser.add_argument(
+    "--chunk-events",
+    help="Number of events per HDF5 chunk of the event datasets.",
+    type=int,
+    default=EVENT_CHUNK
+)
+
+time_window_argparser = argparse.ArgumentParser(add_help=False)
+time_window_argparser.add_argument(
+    "--tmin",
+    help="Only use events at or after this timer tick.",
+    type=int,
+)
+time_window_argparser.add_argument(
+    "--tmax",
+    help="Only use events before this timer tick.",
+    type=int,
+)
+
+def event_layout(compression=DEFAULT_EVENT_COMPRESSION, level=None, shuffle=True, chunk=EVENT_CHUNK):
+    """Keyword arguments for h5py's create_dataset describing the layout of event datasets."""
+    layout = {"chunks":(chunk,)}
+    if compression == "none":
+        return layout
+    if compression == "blosc":
+        if hdf5plugin is None:
+            sys.exit("Blosc compression requires the hdf5plugin package.")
+        shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        layout.update(hdf5plugin.Blosc(cname="lz4", clevel=5 if level is None else level, shuffle=shuffle))
+        return layout
+    layout["compression"] = compression
+    if compression == "gzip" and level is not None:
+        layout["compression_opts"] = level
+    layout["shuffle"] = shuffle
+    return layout
+
+def event_layout_from_args(args):
+    return event_layout(args.compression, args.compression_level, not args.no_shuffle, args.chunk_events)
+
+def event_columns(events):
+    """The event datasets of an EVENTS group by name, without subgroups like SUMMARY."""
+    return {name:ds for name, ds in events.items() if isinstance(ds, h5py.Dataset)}
+
+class SparseCounts:
+    """
+    Histogram counts of the given shape stored as the indices (ndim, n) and counts of the
+    non-empty bins, without duplicates. Supports the few operations the histogram tools need,
+    toarray() gives the dense counts.
+    """
+    def __init__(self, shape, index, count):
+        self.shape = tuple(int(n) for n in shape)
+        self.index = np.asarray(index).reshape(len(self.shape), -1)
+        self.count = np.asarray(count)
+        self.ndim = len(self.shape)
+        self.dtype = self.count.dtype
+
+    @classmethod
+    def from_dense(cls, counts):
+        index = np.nonzero(counts)
+        dtype = np.uint16 if max(counts.shape, default=0) <= 1 << 16 else np.uint32
+        return cls(counts.shape, np.array(index, dtype=dtype), counts[index])
+
+    @property
+    def nnz(self):
+        return self.count.size
+
+    @property
+    def fill(self):
+        """Fraction of non-empty bins."""
+        return self.nnz/max(np.prod(self.shape), 1)
+
+    @property
+    def T(self):
+        return SparseCounts(self.shape[::-1], self.index[::-1], self.count)
+
+    def toarray(self):
+        out = np.zeros(self.shape, dtype=self.dtype)
+        out[tuple(self.index)] = self.count
+        return out
+
+    def sum(self):
+        return self.count.sum()
+
+    def max(self):
+        return self.count.max(initial=0)
+
+    def copy(self):
+        return SparseCounts(self.shape, self.index.copy(), self.count.copy())
+
+    def __getitem__(self, key):
+        # Only slices without step, enough for cropping
+        key = key if isinstance(key, tuple) else (key,)
+        shape = []
+        keep = np.ones(self.nnz, dtype=bool)
+        bounds = []
+        for axis, n in enumerate(self.shape):
+            slc = key[axis] if axis < len(key) else slice(None)
+            if not isinstance(slc, slice) or slc.step not in (None, 1):
+                raise TypeError("Sparse counts can only be sliced without step.")
+            start, stop, _ = slc.indices(n)
+            stop = max(start, stop)
+            keep &= (self.index[axis] >= start) & (self.index[axis] < stop)
+            shape.append(stop - start)
+            bounds.append(start)
+        index = self.index[:, keep] - np.array(bounds, dtype=self.index.dtype)[:, None]
+        return SparseCounts(shape, index, self.count[keep])
+
 def check_input(file_):
     if not os.path.isfile(file_):
         sys.exit(f"The specified file '{file_}' could not be found.")
@@ -82,7 +217,7 @@ def check_output(file_, yes=False):
     return file_
 
 def squeeze_array(arr, n=2, axis=None):
-    out = arr.copy()
+    out = arr.astype(float) # Padded with NaN, which integer counts can not hold
     if axis == 0:
         if out.shape[0]%n:
             out = np.pad(out, ((0, n-out.shape[0]%n), (0, 0)), constant_values=np.nan)
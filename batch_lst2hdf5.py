@@ -0,0 +1,140 @@
+"""
+Convert many MPA-3 list files into HDF5 format in one process with a shared worker pool.
+"""
+import os
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from _common import (
+    event_layout_argparser,
+    event_layout_from_args,
+    read_orchestration_csv,
+)
+from lst2hdf5 import (
+    COMPRESSED_SUFFIXES,
+    convert,
+    strip_compression_suffix,
+)
+
+
+def _parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description="Convert all valid runs of a run table (like useful_files) or all list "\
+                    "files matching glob patterns into HDF5 format. Outputs that are newer "\
+                    "than their list file are skipped.",
+        parents=[event_layout_argparser]
+    )
+    parser.add_argument(
+        "inputs",
+        help="Run tables (*.csv, files are looked up next to the table) and/or list files "\
+             "or glob patterns like 'data/*.lst'.",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        help="Number of files converted concurrently, defaults to the number of CPUs.",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--threads",
+        help="Number of decoding threads per file, see lst2hdf5 --workers.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--force",
+        help="Convert all files, even if their output is up to date.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--dry-run",
+        "-n",
+        help="Only list the files that would be converted.",
+        action="store_true"
+    )
+    return parser.parse_args()
+
+def _find_archived(fin):
+    # Runs archived as compressed list files keep the name from the run table plus a suffix
+    if os.path.exists(fin):
+        return fin
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(fin + suffix):
+            return fin + suffix
+    return fin
+
+def collect_list_files(inputs):
+    files = []
+    for inp in inputs:
+        if inp.endswith(".csv"):
+            df = read_orchestration_csv(inp)
+            files += [_find_archived(os.path.join(os.path.dirname(inp), f)) for f in df.FILE[df.VALID]]
+        else:
+            files += sorted(glob.glob(inp)) or [inp]
+    return list(dict.fromkeys(files)) # Drop duplicates, keep order
+
+def output_file(fin):
+    return os.path.splitext(strip_compression_suffix(fin))[0] + ".h5"
+
+def is_up_to_date(fin, fout):
+    return os.path.isfile(fout) and os.path.getmtime(fout) >= os.path.getmtime(fin)
+
+def _convert_one(fin, fout, threads, layout):
+    # Write to a temporary name first, so a failed conversion never looks up to date. The
+    # leftovers of an interrupted batch are continued from their checkpoints.
+    part = fout + ".part"
+    convert(fin, part, workers=threads, layout=layout, progress=False, resume=True)
+    os.replace(part, fout)
+    return fin
+
+def batch_convert(files, workers=None, threads=1, layout=None):
+    """
+    Convert the given list files with a pool of worker processes. The largest files are
+    submitted first, which keeps the workers evenly loaded until the end. Returns a dict of
+    the files that failed and their exceptions.
+    """
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    sizes = {fin:os.path.getsize(fin) for fin in files}
+    failed = {}
+    tq = tqdm(total=sum(sizes.values()), unit="B", unit_scale=True, desc="Convert ")
+    with ProcessPoolExecutor(workers) as ex:
+        futures = {
+            ex.submit(_convert_one, fin, output_file(fin), threads, layout):fin for fin in files
+        }
+        for fut in as_completed(futures):
+            fin = futures[fut]
+            try:
+                fut.result()
+            except Exception as exc: # Keep going, report at the end
+                failed[fin] = exc
+            tq.update(sizes[fin])
+    tq.close()
+    return failed
+
+def _main():
+    args = _parse_cli_args()
+    files = collect_list_files(args.inputs)
+    missing = [f for f in files if not os.path.isfile(f)]
+    if missing:
+        sys.exit("Could not find the list files:\n" + "\n".join(missing))
+    todo = [f for f in files if args.force or not is_up_to_date(f, output_file(f))]
+    print(f"{len(todo)} of {len(files)} list files need to be converted.")
+    if args.dry_run or not todo:
+        for f in todo:
+            print(f)
+        sys.exit(0)
+
+    failed = batch_convert(todo, args.workers, args.threads, event_layout_from_args(args))
+    for fin, exc in failed.items():
+        print(f"Failed to convert '{fin}': {exc!r}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    _main()
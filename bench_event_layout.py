@@ -0,0 +1,109 @@
+"""
+Benchmark the HDF5 layouts available for event datasets: file size, write and read throughput.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+
+import h5py
+
+from _common import (
+    TYPICAL_DASK_CHUNK,
+    EVENT_CHUNK,
+    EVENT_COMPRESSIONS,
+    hdf5plugin,
+    check_input,
+    event_layout,
+    event_columns,
+)
+
+def _parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description="Rewrite the EVENTS of a converted file with different HDF5 layouts and "\
+                    "report size, write and read throughput for each. Reads are done in "\
+                    "TYPICAL_DASK_CHUNK sized blocks, like generate_hist and extract_roi do. "\
+                    "The files are read right after writing them, drop the page cache "\
+                    "in between for truly cold reads."
+    )
+    parser.add_argument(
+        "file",
+        help="HDF5 file produced by lst2hdf5.",
+        type=str,
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression filters to compare, all available ones by default.",
+        choices=EVENT_COMPRESSIONS,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--chunk-events",
+        help="Chunk sizes to compare.",
+        type=int,
+        nargs="+",
+        default=[EVENT_CHUNK],
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for the rewritten files, should be on the disk of interest.",
+        type=str,
+    )
+    return parser.parse_args()
+
+def _load_events(file_):
+    with h5py.File(file_, "r") as f:
+        return {name:ds[:] for name, ds in event_columns(f["EVENTS"]).items()}
+
+def _write(file_, events, layout):
+    start = perf_counter()
+    with h5py.File(file_, "w") as f:
+        grp = f.create_group("EVENTS")
+        for name, data in events.items():
+            ds = grp.create_dataset(name, shape=data.shape, dtype=data.dtype, **layout)
+            for k in range(0, data.size, TYPICAL_DASK_CHUNK):
+                ds[k:k+TYPICAL_DASK_CHUNK] = data[k:k+TYPICAL_DASK_CHUNK]
+    return perf_counter() - start
+
+def _read(file_):
+    start = perf_counter()
+    with h5py.File(file_, "r") as f:
+        for ds in event_columns(f["EVENTS"]).values():
+            for k in range(0, ds.len(), TYPICAL_DASK_CHUNK):
+                ds[k:k+TYPICAL_DASK_CHUNK]
+    return perf_counter() - start
+
+def benchmark(file_, compressions=None, chunks=(EVENT_CHUNK,), tmpdir=None):
+    if compressions is None:
+        compressions = [c for c in EVENT_COMPRESSIONS if c != "blosc" or hdf5plugin is not None]
+    events = _load_events(file_)
+    nbytes = sum(data.nbytes for data in events.values())
+    layouts = [("contiguous", 0, {})]
+    for chunk in chunks:
+        for compression in compressions:
+            layouts.append((compression, chunk, event_layout(compression, chunk=chunk)))
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        for compression, chunk, layout in layouts:
+            out = os.path.join(tmp, f"{compression}_{chunk}.h5")
+            t_write = _write(out, events, layout)
+            t_read = _read(out)
+            results.append((compression, chunk, os.path.getsize(out), t_write, t_read))
+            os.remove(out)
+    return nbytes, results
+
+def _main():
+    args = _parse_cli_args()
+    check_input(args.file)
+    nbytes, results = benchmark(args.file, args.compression, args.chunk_events, args.tmpdir)
+    print(f"{'layout':>12} {'chunk':>8} {'size MB':>9} {'ratio':>6} {'write MB/s':>11} {'read MB/s':>10}")
+    for compression, chunk, size, t_write, t_read in results:
+        print(
+            f"{compression:>12} {chunk:>8} {size/1e6:>9.1f} {nbytes/size:>6.2f} "\
+            f"{nbytes/1e6/t_write:>11.1f} {nbytes/1e6/t_read:>10.1f}"
+        )
+    sys.exit(0)
+
+if __name__ == "__main__":
+    _main()
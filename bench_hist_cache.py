@@ -0,0 +1,103 @@
+"""
+Benchmark of the histogram cache of generate_hist on a synthetic list file, its ROI and its
+indexed ROI. The first histogram of each file fills the cache, the second one with another
+binning has to be served from it. Both are checked against histograms without cache.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import h5py
+
+import lst2hdf5
+import synth_lst
+import generate_hist
+from extract_roi import parse_roi, extract_rois
+from hist_cache import HistogramCache
+
+
+def _parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description="Measure cold and cached 2D histograms of a synthetic converted file and "\
+                    "of ROIs extracted from it, and check that rebinning is served from the cache."
+    )
+    parser.add_argument(
+        "--size",
+        help="Size of the generated list data in MB.",
+        type=float,
+        default=50.,
+    )
+    parser.add_argument(
+        "--bins",
+        help="Bins per axis of the first and the second histogram.",
+        type=int,
+        nargs=2,
+        default=[256, 512],
+    )
+    parser.add_argument(
+        "--roi",
+        help="ROI to extract, as for extract_roi --roi.",
+        type=str,
+        nargs="+",
+        default=["ADC1", "strip", "2000", "6000"],
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for generated files and the cache, should be on the disk of interest.",
+        type=str,
+    )
+    return parser.parse_args()
+
+def _cached(cache, file_, xchannel, ychannel, nbins):
+    # Whether the histogram can be rebinned from the cache, without reading any events
+    base = cache.load(cache.key(file_, xchannel, ychannel))
+    if base is None:
+        return False
+    with h5py.File(file_, "r") as f:
+        config = generate_hist._h5_config(f)
+    acc = generate_hist.HistogramAccumulator(xchannel, ychannel, nbins, nbins, config=config)
+    return generate_hist._covers(acc, base[0].shape, base[1])
+
+def bench_file(file_, cache, bins, xchannel="ADC2", ychannel="ADC3"):
+    results = []
+    for nbins in bins:
+        direct = generate_hist.hist2d_from_mpa_data(file_, xchannel, ychannel, nbins, nbins)[0]
+        cached = _cached(cache, file_, xchannel, ychannel, nbins)
+        start = perf_counter()
+        counts = generate_hist.hist2d_from_mpa_data(file_, xchannel, ychannel, nbins, nbins, cache=cache)[0]
+        elapsed = perf_counter() - start
+        results.append((nbins, elapsed, cached, np.array_equal(counts, direct)))
+    return results
+
+def _main():
+    args = _parse_cli_args()
+    try:
+        roi = parse_roi(args.roi)
+    except ValueError as e:
+        sys.exit(str(e))
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmp:
+        fin = os.path.join(tmp, "synthetic.lst")
+        synth_lst.generate(fin, args.size*1e6)
+        converted = os.path.join(tmp, "synthetic.h5")
+        lst2hdf5.convert(fin, converted)
+        copied = os.path.join(tmp, "synthetic_DR.h5roi")
+        indexed = os.path.join(tmp, "synthetic_DRi.h5roi")
+        extract_rois(converted, [(copied, roi)])
+        extract_rois(converted, [(indexed, roi)], index=True)
+
+        cache = HistogramCache(os.path.join(tmp, "cache"))
+        results = []
+        for name, file_ in [("converted", converted), ("ROI", copied), ("indexed ROI", indexed)]:
+            (n0, t0, _, ok0), (n1, t1, cached, ok1) = bench_file(file_, cache, args.bins)
+            results.append((name, n0, t0, n1, t1, cached, ok0 and ok1))
+
+    print(f"{'file':>12} {'bins':>6} {'cold s':>8} {'bins':>6} {'cached s':>9} {'hit':>5} {'check':>6}")
+    for name, n0, t0, n1, t1, cached, ok in results:
+        print(f"{name:>12} {n0:>6} {t0:>8.2f} {n1:>6} {t1:>9.2f} {'yes' if cached else 'no':>5} {'OK' if ok else 'FAIL':>6}")
+    sys.exit(0 if all(cached and ok for *_, cached, ok in results) else 1)
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,190 @@
+"""
+Throughput benchmark for lst2hdf5 with round-trip checks against the ground truth of a
+synthetic list file. The compact codec is also checked on a synthetic file with pauses of
+PAUSE_TICKS between the events, whose TIME differences are wider than any ADC value.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import h5py
+
+from _common import (
+    TYPICAL_DASK_CHUNK,
+    EVENT_COMPRESSIONS,
+    DEFAULT_EVENT_COMPRESSION,
+    event_layout,
+)
+from events import columns
+import lst2hdf5
+import synth_lst
+
+PAUSE_TICKS = 200_000 # TIME differences of 18 bits, beyond the 16 bits of ADC values
+PAUSE_SIZE = 20e6
+
+
+def _parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the stages of lst2hdf5 and check the results "\
+                    "against the known content of a synthetic list file."
+    )
+    parser.add_argument(
+        "--lst",
+        help="Benchmark an existing list file instead of generating one.",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--truth",
+        help="Ground truth for --lst as written by synth_lst --truth.",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--size",
+        help="Size of the generated list data in MB.",
+        type=float,
+        default=200.,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Worker counts to run the end to end conversion with.",
+        type=int,
+        nargs="+",
+        default=[1],
+    )
+    parser.add_argument(
+        "--compression",
+        help="Compression of the converted event datasets.",
+        choices=EVENT_COMPRESSIONS,
+        default=DEFAULT_EVENT_COMPRESSION,
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for generated and converted files, should be on the disk of interest.",
+        type=str,
+    )
+    return parser.parse_args()
+
+def _list_data(fin):
+    with open(fin, "rb") as f:
+        lst2hdf5._read_header(f)
+        offset = f.tell()
+    return offset, os.path.getsize(fin) - offset
+
+def compare_events(file_, truth):
+    """Names of the EVENTS datasets in file_ that differ from truth, checked chunk by chunk."""
+    bad = []
+    with h5py.File(file_, "r") as f, h5py.File(truth, "r") as t:
+        ev, tev = columns(f["EVENTS"]), columns(t["EVENTS"])
+        for name in sorted(set(ev) | set(tev)):
+            if name not in ev or name not in tev or ev[name].shape != tev[name].shape:
+                bad.append(name)
+                continue
+            for k in range(0, tev[name].len(), TYPICAL_DASK_CHUNK):
+                slc = np.s_[k:k+TYPICAL_DASK_CHUNK]
+                if not np.array_equal(ev[name][slc], tev[name][slc]):
+                    bad.append(name)
+                    break
+    return bad
+
+def _n_truth_events(truth):
+    with h5py.File(truth, "r") as t:
+        return t["EVENTS/TIME"].len()
+
+def bench_explore(fin, n_truth):
+    start = perf_counter()
+    explore = lst2hdf5.explore_list_file(fin)
+    return perf_counter() - start, explore["n_event"], explore["n_event"] == n_truth
+
+def bench_kernels(fin, n_truth):
+    """Time the decoding kernels on the memory mapped chunks of fin."""
+    offset, _ = _list_data(fin)
+    chunks = list(lst2hdf5._iter_mmap_chunks(fin, offset))
+    # Trigger compilation (or loading from the cache) outside of the timings
+    warm = chunks[0][0][:1000]
+    lst2hdf5._assemble_output_array(*lst2hdf5._extract_event_data(warm)[:4])
+    lst2hdf5._extract_event_columns(warm, *_column_buffers(lst2hdf5._count_event_data(warm)[0]))
+
+    t_extract = t_assemble = t_columns = 0.
+    n_extract = n_columns = 0
+    for arr, _ in chunks:
+        start = perf_counter()
+        event_id, time, channel, value, _ = lst2hdf5._extract_event_data(arr)
+        t_extract += perf_counter() - start
+        if event_id.size > 0:
+            start = perf_counter()
+            lst2hdf5._assemble_output_array(event_id, time, channel, value)
+            t_assemble += perf_counter() - start
+            n_extract += int(event_id[-1]) + 1
+        del event_id, time, channel, value
+
+        start = perf_counter()
+        n_event, adc_mask = lst2hdf5._count_event_data(arr)
+        out_time, out_columns = _column_buffers(n_event)
+        for i in range(16):
+            if (adc_mask >> i) & 0x01:
+                out_columns[i] = lst2hdf5.INVALID_ADC_VALUE
+        n_event, _ = lst2hdf5._extract_event_columns(arr, out_time, out_columns)
+        t_columns += perf_counter() - start
+        n_columns += n_event
+    return [
+        ("_extract_event_data", t_extract, n_extract, n_extract == n_truth),
+        ("_assemble_output_array", t_assemble, n_extract, n_extract == n_truth),
+        ("count + _extract_event_columns", t_columns, n_columns, n_columns == n_truth),
+    ]
+
+def _column_buffers(n_event):
+    return np.empty(n_event, dtype=np.uint32), np.empty((16, n_event), dtype=np.uint16)
+
+def bench_convert(fin, fout, truth, workers, compression, compact=False):
+    start = perf_counter()
+    lst2hdf5.convert(fin, fout, workers=workers, layout=event_layout(compression), compact=compact)
+    elapsed = perf_counter() - start
+    with h5py.File(fout, "r") as f:
+        n_event = columns(f["EVENTS"])["TIME"].len()
+    return elapsed, n_event, not compare_events(fout, truth)
+
+def bench_pauses(tmp):
+    """Round trip of the compact codec through a synthetic file with long pauses."""
+    fin = os.path.join(tmp, "pauses.lst")
+    truth = os.path.join(tmp, "pauses_truth.h5")
+    synth_lst.generate(fin, PAUSE_SIZE, truth=truth, pause=PAUSE_TICKS)
+    return bench_convert(fin, os.path.join(tmp, "pauses.h5"), truth, 1, "lzf", compact=True)
+
+def _main():
+    args = _parse_cli_args()
+    if bool(args.lst) != bool(args.truth):
+        sys.exit("--lst and --truth have to be given together.")
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmp:
+        fin, truth = args.lst, args.truth
+        if not fin:
+            fin = os.path.join(tmp, "synthetic.lst")
+            truth = os.path.join(tmp, "synthetic_truth.h5")
+            synth_lst.generate(fin, args.size*1e6, truth=truth)
+        _, nbytes = _list_data(fin)
+        n_truth = _n_truth_events(truth)
+
+        results = []
+        t, n, ok = bench_explore(fin, n_truth)
+        results.append(("explore_list_file", t, n, ok))
+        results += bench_kernels(fin, n_truth)
+        for workers in args.workers:
+            t, n, ok = bench_convert(fin, os.path.join(tmp, "converted.h5"), truth, workers, args.compression)
+            results.append((f"convert (workers={workers}, {args.compression})", t, n, ok))
+        t, n, ok = bench_convert(fin, os.path.join(tmp, "compact.h5"), truth, 1, args.compression, compact=True)
+        results.append(("convert (compact)", t, n, ok))
+        _, _, pauses_ok = bench_pauses(tmp)
+
+    print(f"List data: {nbytes/1e6:.1f} MB, {n_truth} events")
+    print(f"{'stage':>40} {'time s':>8} {'MB/s':>8} {'Mevents/s':>10} {'check':>6}")
+    for name, t, n, ok in results:
+        print(f"{name:>40} {t:>8.2f} {nbytes/1e6/t:>8.1f} {n/1e6/t:>10.2f} {'OK' if ok else 'FAIL':>6}")
+    print(f"Compact round trip with pauses of {PAUSE_TICKS} ticks: {'OK' if pauses_ok else 'FAIL'}")
+    sys.exit(0 if pauses_ok and all(ok for *_, ok in results) else 1)
+
+if __name__ == "__main__":
+    _main()
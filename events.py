@@ -0,0 +1,333 @@
+"""
+Access to the events of files converted with lst2hdf5.
+
+Besides plain HDF5 datasets, event columns can be stored with the compact codec. Events are cut
+into blocks of COMPACT_BLOCK, each column is a group with the packed bytes of all blocks (DATA)
+and a table with the byte offset, bit width and base value of every block (BLOCKS).
+TIME blocks hold the differences to the preceding event, ADC blocks a bitmask of the events
+with a value followed by the values minus their minimum. Both are bit-packed with the width
+of their largest entry, ADC blocks without any values take no space at all. columns() hides
+the difference, its columns can be sliced like datasets and decode on access.
+
+ROI files written by extract_roi --index hold no event data of their own (or only a few
+projected columns), but the sorted indices of the selected events (INDEX) in the parent file
+they reference. columns() reads their columns from the parent through IndexedColumns.
+"""
+import os
+
+import numpy as np
+import numba as nb
+import h5py
+
+from _common import (
+    INVALID_ADC_VALUE,
+    EVENT_CHUNK,
+    event_columns,
+)
+
+COMPACT_BLOCK = EVENT_CHUNK
+INDEXED_MAX_SPAN = 64*EVENT_CHUNK # Parent events read at once by an IndexedColumn
+
+
+def is_compact(events):
+    return events.attrs.get("codec", "plain") == "compact"
+
+def is_indexed(events):
+    return events.attrs.get("codec", "plain") == "index"
+
+def parent_file(events):
+    """Path of the parent file of the indexed EVENTS group events."""
+    return os.path.join(os.path.dirname(events.file.filename), events.attrs["parent"])
+
+@nb.njit(cache=True, nogil=True)
+def _bit_width(v):
+    width = 0
+    while v > 0:
+        width += 1
+        v >>= 1
+    return width
+
+@nb.njit(cache=True, nogil=True)
+def _encode_time_block(time, out):
+    # Returns the number of bytes written to out, the bit width and the base value
+    n = time.size
+    dmax = 0
+    for i in range(1, n):
+        dmax = max(dmax, np.int64(time[i]) - np.int64(time[i - 1]))
+    width = _bit_width(dmax)
+    acc = 0
+    n_acc = 0
+    pos = 0
+    for i in range(1, n):
+        acc |= (np.int64(time[i]) - np.int64(time[i - 1])) << n_acc
+        n_acc += width
+        while n_acc >= 8:
+            out[pos] = acc & 0xff
+            acc >>= 8
+            n_acc -= 8
+            pos += 1
+    if n_acc > 0:
+        out[pos] = acc & 0xff
+        pos += 1
+    return pos, width, np.int64(time[0]) if n > 0 else 0
+
+@nb.njit(cache=True, nogil=True)
+def _encode_adc_block(column, out):
+    # Returns the number of bytes written to out, the bit width and the base value
+    n = column.size
+    n_value = 0
+    vmin = INVALID_ADC_VALUE
+    vmax = 0
+    for i in range(n):
+        v = column[i]
+        if v != INVALID_ADC_VALUE:
+            n_value += 1
+            vmin = min(vmin, v)
+            vmax = max(vmax, v)
+    if n_value == 0:
+        return 0, 0, 0
+    pos = (n + 7)//8
+    out[:pos] = 0
+    width = _bit_width(np.int64(vmax) - np.int64(vmin))
+    acc = 0
+    n_acc = 0
+    for i in range(n):
+        v = column[i]
+        if v == INVALID_ADC_VALUE:
+            continue
+        out[i >> 3] |= 1 << (i & 7)
+        acc |= (np.int64(v) - np.int64(vmin)) << n_acc
+        n_acc += width
+        while n_acc >= 8:
+            out[pos] = acc & 0xff
+            acc >>= 8
+            n_acc -= 8
+            pos += 1
+    if n_acc > 0:
+        out[pos] = acc & 0xff
+        pos += 1
+    return pos, width, np.int64(vmin)
+
+@nb.njit(cache=True, nogil=True)
+def _decode_time_blocks(data, offsets, widths, bases, block, n_event, out):
+    # Decodes consecutive blocks, data starts at offsets[0], out holds n_event events
+    for k in range(offsets.size - 1):
+        pos = offsets[k] - offsets[0]
+        width = widths[k]
+        mask = (1 << width) - 1
+        first = k*block
+        stop = min(first + block, n_event)
+        t = bases[k]
+        out[first] = t
+        acc = 0
+        n_acc = 0
+        for i in range(first + 1, stop):
+            while n_acc < width:
+                acc |= np.int64(data[pos]) << n_acc
+                pos += 1
+                n_acc += 8
+            t += acc & mask
+            acc >>= width
+            n_acc -= width
+            out[i] = t
+
+@nb.njit(cache=True, nogil=True)
+def _decode_adc_blocks(data, offsets, widths, bases, block, n_event, out):
+    for k in range(offsets.size - 1):
+        first = k*block
+        stop = min(first + block, n_event)
+        if offsets[k + 1] == offsets[k]: # No values in this block
+            out[first:stop] = INVALID_ADC_VALUE
+            continue
+        start = offsets[k] - offsets[0]
+        pos = start + (stop - first + 7)//8
+        width = widths[k]
+        mask = (1 << width) - 1
+        acc = 0
+        n_acc = 0
+        for i in range(first, stop):
+            j = i - first
+            if not (data[start + (j >> 3)] >> (j & 7)) & 0x01:
+                out[i] = INVALID_ADC_VALUE
+                continue
+            while n_acc < width:
+                acc |= np.int64(data[pos]) << n_acc
+                pos += 1
+                n_acc += 8
+            out[i] = (acc & mask) + bases[k]
+            acc >>= width
+            n_acc -= width
+
+def encode_buffer_size(n):
+    """
+    Bytes needed to encode a block of n events of any column: TIME differences take up to 32
+    bits each, more than the 16 bits and the bitmask of ADC values.
+    """
+    return 4*n + 8
+
+def encode_block(name, values, out):
+    """
+    Encodes one block of the column name into the uint8 buffer out, which needs room for
+    encode_buffer_size(values.size) bytes. Returns the number of bytes, bit width and base.
+    """
+    if name == "TIME":
+        return _encode_time_block(values, out)
+    return _encode_adc_block(values, out)
+
+class CompactColumn:
+    """
+    Read-only view of a column stored with the compact codec. Supports len(), shape, dtype
+    and indexing with integers and slices like an h5py dataset, only the blocks covering the
+    selection are read and decoded.
+    """
+    def __init__(self, group, name, n_event, block):
+        self.name = name
+        self.data = group["DATA"]
+        self.blocks = group["BLOCKS"][:]
+        self.block = block
+        self.shape = (n_event,)
+        self.ndim = 1
+        self.size = n_event
+        self.dtype = np.dtype(np.uint32 if name == "TIME" else np.uint16)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def len(self):
+        return self.shape[0]
+
+    def _decode(self, start, stop):
+        n_event = self.shape[0]
+        k0, k1 = start//self.block, (stop - 1)//self.block + 1
+        end = self.blocks[k1, 0] if k1 < len(self.blocks) else self.data.len()
+        offsets = np.append(self.blocks[k0:k1, 0], end)
+        data = self.data[offsets[0]:offsets[-1]]
+        out = np.empty(min(k1*self.block, n_event) - k0*self.block, dtype=self.dtype)
+        decode = _decode_time_blocks if self.name == "TIME" else _decode_adc_blocks
+        decode(data, offsets, self.blocks[k0:k1, 1], self.blocks[k0:k1, 2], self.block, out.size, out)
+        return out[start - k0*self.block:stop - k0*self.block]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 1:
+            key = key[0]
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.shape[0]
+            if not 0 <= key < self.shape[0]:
+                raise IndexError(f"Index {key} out of range for {self.shape[0]} events.")
+            return self._decode(key, key + 1)[0]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if stop <= start:
+                return np.empty(0, dtype=self.dtype)
+            return self._decode(start, stop)[::step]
+        raise TypeError("Compact event columns can only be indexed with integers and slices.")
+
+class IndexedColumn:
+    """
+    Read-only view of the events of a parent column selected by the sorted indices in the
+    dataset index. Slices read the range of the parent covering the selection (in pieces of
+    at most INDEXED_MAX_SPAN events) and pick the selected events from it.
+    """
+    def __init__(self, parent, index, name):
+        self.name = name
+        self.parent = parent
+        self.index = index
+        self.shape = (index.len(),)
+        self.ndim = 1
+        self.size = self.shape[0]
+        self.dtype = parent.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def len(self):
+        return self.shape[0]
+
+    def _read(self, start, stop):
+        idx = self.index[start:stop]
+        out = np.empty(idx.size, dtype=self.dtype)
+        pos = 0
+        while pos < idx.size:
+            lo = int(idx[pos])
+            end = pos + int(np.searchsorted(idx[pos:], lo + INDEXED_MAX_SPAN))
+            block = self.parent[lo:int(idx[end - 1]) + 1]
+            out[pos:end] = block[idx[pos:end] - lo]
+            pos = end
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 1:
+            key = key[0]
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self.shape[0]
+            if not 0 <= key < self.shape[0]:
+                raise IndexError(f"Index {key} out of range for {self.shape[0]} events.")
+            return self.parent[int(self.index[key])]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if stop <= start:
+                return np.empty(0, dtype=self.dtype)
+            return self._read(start, stop)[::step]
+        raise TypeError("Indexed event columns can only be indexed with integers and slices.")
+
+def column_names(events):
+    if is_indexed(events):
+        with h5py.File(parent_file(events), "r", swmr=True) as parent:
+            names = column_names(parent["EVENTS"])
+        return list(dict.fromkeys(names + [n for n in event_columns(events) if n != "INDEX"]))
+    if not is_compact(events):
+        return list(event_columns(events))
+    return [name for name, grp in events.items() if "DATA" in grp]
+
+def columns(events):
+    """
+    The event columns of the EVENTS group events by name, h5py datasets for plain files,
+    CompactColumns for files written with the compact codec and IndexedColumns for indexed ROI
+    files (except for their projected columns). The parent of an indexed file stays open as
+    long as its columns are referenced.
+    """
+    if is_indexed(events):
+        index = events["INDEX"]
+        parent = h5py.File(parent_file(events), "r", swmr=True)
+        cols = {
+            name:IndexedColumn(col, index, name) for name, col in columns(parent["EVENTS"]).items()
+        }
+        cols.update({name:ds for name, ds in event_columns(events).items() if name != "INDEX"})
+        return cols
+    if not is_compact(events):
+        return event_columns(events)
+    n_event = events.attrs["n_event"]
+    block = events.attrs["block_events"]
+    return {
+        name:CompactColumn(events[name], name, n_event, block) for name in column_names(events)
+    }
+
+def _bisect(ds, value, lo, hi):
+    # First index in [lo, hi) with ds[index] >= value for the sorted dataset ds
+    while lo < hi:
+        mid = (lo + hi)//2
+        if ds[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _time_offset(events, time, t, n):
+    index = events.get("SUMMARY/TIME_INDEX")
+    if index is not None:
+        return min(int(index[min(max(t, 0), index.len() - 1)]), n)
+    return _bisect(time, t, 0, n)
+
+def time_window(events, tmin=None, tmax=None):
+    """
+    Start and stop of the events with tmin <= TIME < tmax (in timer ticks, None for no limit)
+    in the EVENTS group events. Looked up in the TIME_INDEX written by lst2hdf5 or by bisection
+    of TIME for files without one, so only a handful of values are read either way.
+    """
+    time = columns(events)["TIME"]
+    n = time.len() # ADC columns of files in SWMR mode may run ahead of TIME
+    start = 0 if tmin is None else _time_offset(events, time, tmin, n)
+    stop = n if tmax is None else _time_offset(events, time, tmax, n)
+    return start, max(start, stop)
@@ -3,6 +3,9 @@ import sys
 import os
 
 import argparse
+from contextlib import ExitStack
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import numba as nb
@@ -18,50 +21,332 @@ from _common import (
     check_input,
     check_output,
     default_argparser,
+    time_window_argparser,
 )
+from events import time_window, columns, is_indexed, parent_file
 
-@nb.njit(cache=True, parallel=True)
-def _check_roi_1d(data, dmin, dmax):
-    return np.logical_and(np.logical_and(dmin <= data, data <= dmax), data != INVALID_ADC_VALUE)
+@nb.njit(cache=True, nogil=True)
+def _inside_1d(x, lut):
+    return lut[x]
 
-@nb.njit(cache=True, parallel=True)
-def _check_roi_2d_rect(xdata, xmin, xmax, ydata, ymin, ymax):
-    return np.logical_and(
-        _check_roi_1d(xdata, xmin, xmax),
-        _check_roi_1d(ydata, ymin, ymax)
-    )
+@nb.njit(cache=True, nogil=True)
+def _inside_2d(x, y, bits, x0, y0):
+    # bits is the bitmask of the bounding box starting at (x0, y0), packed along y
+    dx = np.int64(x) - x0
+    dy = np.int64(y) - y0
+    if dx < 0 or dx >= bits.shape[0] or dy < 0 or dy >= bits.shape[1]*8:
+        return False
+    return (bits[dx, dy >> 3] >> (dy & 7)) & 1 == 1
+
+@nb.njit(cache=True, nogil=True)
+def in_rois(i, strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+    """
+    Whether event i is inside all ROIs described by the arguments of in_rois_args, for use in
+    numba kernels that classify events on the fly.
+    """
+    if strip_x is not None:
+        for g in range(strip_lut.shape[0]):
+            if not _inside_1d(strip_x[g][i], strip_lut[g]):
+                return False
+    if box_x is not None:
+        for g in range(box_bits.shape[0]):
+            if not _inside_2d(box_x[g][i], box_y[g][i], box_bits[g], box_x0[g], box_y0[g]):
+                return False
+    return True
+
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _mask_1d(x, lut, out):
+    for i in nb.prange(x.size):
+        out[i] = _inside_1d(x[i], lut)
+
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _mask_2d(x, y, bits, x0, y0, out):
+    for i in nb.prange(x.size):
+        out[i] = _inside_2d(x[i], y[i], bits, x0, y0)
+
+@nb.njit(cache=True)
+def _rasterize_poly(xvert, yvert, x0, y0, w, h):
+    # Ray casting like a point in polygon test on every point of the grid, row by row: a point
+    # is inside if an odd number of edges cross its row to the right of it. Returns the bitmask
+    # packed along y like np.packbits(..., axis=1, bitorder="little").
+    bits = np.zeros((w, (h + 7)//8), dtype=np.uint8)
+    n = xvert.size
+    cross = np.empty(n, dtype=np.float64)
+    for dy in range(h):
+        ypoint = np.float64(y0 + dy)
+        n_cross = 0
+        for i in range(n):
+            j = i - 1 if i > 0 else n - 1
+            if (yvert[i] > ypoint) != (yvert[j] > ypoint):
+                cross[n_cross] = (xvert[j] - xvert[i])*(ypoint - yvert[i])/(yvert[j] - yvert[i]) + xvert[i]
+                n_cross += 1
+        c = np.sort(cross[:n_cross])
+        k = 0
+        byte = dy >> 3
+        bit = np.uint8(1 << (dy & 7))
+        for dx in range(w):
+            xpoint = np.float64(x0 + dx)
+            while k < n_cross and c[k] <= xpoint:
+                k += 1
+            if (n_cross - k) % 2 == 1:
+                bits[dx, byte] |= bit
+    return bits
+
+class Roi:
+    """
+    A ROI rasterized once over the integer ADC values. Strips are a table of all uint16
+    values, rectangles and polygons a bitmask over their bounding box (packed, 8 MB for
+    8192x8192 values). Events are classified with a single lookup per event, so polygons with
+    many vertices cost the same as rectangles. Bounds are inclusive, INVALID_ADC_VALUE is never
+    inside.
+    """
+    def __init__(self, kind, roiargs, xchannel, ychannel=""):
+        self.kind = kind
+        self.roiargs = list(roiargs)
+        self.xchannel = xchannel
+        self.ychannel = ychannel
+        if kind == "1D":
+            dmin, dmax = _clip(min(roiargs)), _clip(max(roiargs))
+            self.lut = np.zeros(INVALID_ADC_VALUE + 1, dtype=np.bool_)
+            self.lut[dmin:dmax + 1] = True
+            return
+        if kind == "2DRect":
+            xvert = np.array(roiargs[:2], dtype=np.float64)
+            yvert = np.array(roiargs[2:], dtype=np.float64)
+        elif kind == "2DPoly":
+            xvert = np.array(roiargs[::2], dtype=np.float64)
+            yvert = np.array(roiargs[1::2], dtype=np.float64)
+        else:
+            raise ValueError(f"Unknown kind of ROI '{kind}'.")
+        self.x0, self.y0 = _clip(xvert.min()), _clip(yvert.min())
+        w = max(_clip(xvert.max()) - self.x0 + 1, 0)
+        h = max(_clip(yvert.max()) - self.y0 + 1, 0)
+        if kind == "2DRect":
+            self.bits = np.zeros((w, (h + 7)//8), dtype=np.uint8)
+            self.bits[:, :h//8] = 0xff
+            if h % 8:
+                self.bits[:, h//8] = (1 << (h % 8)) - 1
+        else:
+            self.bits = _rasterize_poly(xvert, yvert, self.x0, self.y0, w, h)
+
+    @property
+    def channels(self):
+        return [c for c in (self.xchannel, self.ychannel) if c]
+
+    @property
+    def spec(self):
+        """The ROI in the syntax of parse_roi."""
+        kind = {v:k for k, v in ROI_KINDS.items()}[self.kind]
+        return " ".join([":".join(self.channels), kind] + [str(v) for v in self.roiargs])
+
+    def mask(self, x, y=None, out=None):
+        """Whether the events with the values x (and y for 2D ROIs) are inside."""
+        if out is None:
+            out = np.empty(x.size, dtype=np.bool_)
+        if self.kind == "1D":
+            _mask_1d(x, self.lut, out)
+        else:
+            _mask_2d(x, y, self.bits, self.x0, self.y0, out)
+        return out
+
+def roi_tables(rois):
+    """
+    The lookup tables of rois as taken by in_rois: the tables of the strips stacked into
+    strip_lut, the bitmasks of the 2D ROIs zero padded to the same size and stacked into
+    box_bits with their origins box_x0 and box_y0. None where there are no such ROIs.
+    """
+    strips = [roi for roi in rois if roi.kind == "1D"]
+    boxes = [roi for roi in rois if roi.kind != "1D"]
+    strip_lut = np.stack([roi.lut for roi in strips]) if strips else None
+    if not boxes:
+        return strip_lut, None, None, None
+    w = max(roi.bits.shape[0] for roi in boxes)
+    h = max(roi.bits.shape[1] for roi in boxes)
+    box_bits = np.zeros((len(boxes), w, h), dtype=np.uint8)
+    for g, roi in enumerate(boxes):
+        box_bits[g, :roi.bits.shape[0], :roi.bits.shape[1]] = roi.bits
+    box_x0 = np.array([roi.x0 for roi in boxes], dtype=np.int64)
+    box_y0 = np.array([roi.y0 for roi in boxes], dtype=np.int64)
+    return strip_lut, box_bits, box_x0, box_y0
+
+def in_rois_args(rois, tables, columns):
+    """
+    The arguments of in_rois after the event for rois with their tables (of roi_tables) and the
+    column chunks they classify: the values of the strips (strip_x) and of the 2D ROIs (box_x,
+    box_y) as tuples next to their tables, None where there are no such ROIs. Nothing is copied.
+    """
+    strips = [roi for roi in rois if roi.kind == "1D"]
+    boxes = [roi for roi in rois if roi.kind != "1D"]
+    strip_lut, box_bits, box_x0, box_y0 = tables
+    strip_x = tuple(np.ascontiguousarray(columns[roi.xchannel]) for roi in strips) or None
+    box_x = tuple(np.ascontiguousarray(columns[roi.xchannel]) for roi in boxes) or None
+    box_y = tuple(np.ascontiguousarray(columns[roi.ychannel]) for roi in boxes) or None
+    # Values next to their tables, numba generated several times slower kernels for other orders
+    return strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0
+
+def _clip(v):
+    # Limit ROI bounds to the valid ADC values
+    return int(min(max(v, 0), INVALID_ADC_VALUE - 1))
+
+ROI_KINDS = {"strip":"1D", "rect":"2DRect", "poly":"2DPoly"}
 
+def parse_roi(tokens):
+    """
+    A Roi from the tokens 'XCHANNEL[:YCHANNEL] strip|rect|poly VALUES...', e.g. 'ADC1 strip
+    5500 7500' or 'ADC2:ADC1 poly 1 5000 8191 5790 8191 8191'. Values are inclusive like the
+    arguments of --strip, --rect and --poly. Raises ValueError for invalid specifications.
+    """
+    if len(tokens) < 3 or tokens[1] not in ROI_KINDS:
+        raise ValueError(f"Invalid ROI '{' '.join(tokens)}', expected 'CHANNELS strip|rect|poly VALUES...'.")
+    xchannel, _, ychannel = tokens[0].partition(":")
+    kind = ROI_KINDS[tokens[1]]
+    values = [int(v) for v in tokens[2:]]
+    if kind == "1D" and (ychannel or len(values) != 2):
+        raise ValueError("A strip needs one channel and two values.")
+    if kind == "2DRect" and (not ychannel or len(values) != 4):
+        raise ValueError("A rect needs two channels and four values.")
+    if kind == "2DPoly" and (not ychannel or len(values) < 6 or len(values)%2):
+        raise ValueError("A poly needs two channels and at least three vertices.")
+    return Roi(kind, values, xchannel, ychannel)
 
-def _make_check_roi_2d_poly(xvert, yvert):
-    xvert = xvert.astype(np.float)
-    yvert = yvert.astype(np.float)
-    _xmin = xvert.min()
-    _xmax = xvert.max()
-    _ymin = yvert.min()
-    _ymax = yvert.max()
-
-    @nb.vectorize([nb.b1(nb.f4, nb.f4)], target="parallel")
-    def _check_roi_2d_poly(xpoint, ypoint):
-        bbox = _check_roi_2d_rect(xpoint, _xmin, _xmax, ypoint, _ymin, _ymax)
-        inside = False
-        for i, j in zip(range(xvert.size), range(-1, xvert.size-1)):
-            if bbox:
-                if (yvert[i] > ypoint) != (yvert[j] > ypoint):
-                    if xpoint < (xvert[j]-xvert[i])*(ypoint-yvert[i])/(yvert[j]-yvert[i]) + xvert[i]:
-                        inside = not inside
-        return inside
-    return _check_roi_2d_poly
+class _RoiWriter:
+    """
+    Writes the events in roi to the open output file fout: copies of all event columns, or with
+    index=True the indices of the events into the parent file and the projected columns.
+    """
+    def __init__(self, fout, roi, fin, file_, cols_in, index=False, projection=()):
+        self.fout = fout
+        self.roi = roi
+        self.pos = 0
+        eve_in = fin["EVENTS"]
+        datafile = fin.attrs.get("datafile", None)
+        fout["datafile"] = datafile or os.path.basename(file_)
+        eve_out = fout.create_group("EVENTS")
+        self.index = None
+        if index:
+            # Indices refer to the file with the event data, ROIs of indexed files share its parent
+            parent = parent_file(eve_in) if is_indexed(eve_in) else file_
+            parent = os.path.relpath(parent, os.path.dirname(os.path.abspath(fout.filename)))
+            fout["CFG"] = h5py.ExternalLink(parent, "/CFG")
+            eve_out.attrs["codec"] = "index"
+            eve_out.attrs["parent"] = parent
+            self.index = eve_out.create_dataset(
+                "INDEX", (0,), maxshape=(None,), dtype=np.uint64, chunks=(TYPICAL_DASK_CHUNK,),
+                compression="gzip", shuffle=True
+            )
+            names = list(projection)
+        else:
+            fin.copy("CFG", fout)
+            names = list(cols_in)
+        self.columns = {
+            name:eve_out.create_dataset(name, (0,), maxshape=cols_in[name].shape, dtype=cols_in[name].dtype)
+            for name in names
+        }
+
+    def select(self, chunk, index):
+        """The events inside the ROI from chunk (columns by name) and index, by dataset name."""
+        roi = self.roi
+        in_roi = roi.mask(chunk[roi.xchannel], chunk[roi.ychannel] if roi.ychannel else None)
+        selected = {name:chunk[name][in_roi] for name in self.columns}
+        if self.index is not None:
+            selected["INDEX"] = index[in_roi]
+        return selected
+
+    def append(self, selected):
+        """Append the output of select."""
+        n_roi = len(next(iter(selected.values()))) if selected else 0
+        stop = self.pos + n_roi
+        for name, data in selected.items():
+            stor = self.index if name == "INDEX" else self.columns[name]
+            stor.resize(stop, axis=0)
+            stor[self.pos:stop] = data
+        self.pos = stop
+
+    def finalize(self, file_, tmin=None, tmax=None):
+        roiinf = self.fout.create_group("ROI")
+        roiinf.attrs["kind"] = self.roi.kind
+        roiinf.attrs["roiargs"] = str(self.roi.roiargs)
+        roiinf.attrs["xchannel"] = self.roi.xchannel
+        roiinf.attrs["basefile"] = os.path.basename(file_)
+        if self.roi.ychannel:
+            roiinf.attrs["ychannel"] = self.roi.ychannel
+        if tmin is not None:
+            roiinf.attrs["tmin"] = tmin
+        if tmax is not None:
+            roiinf.attrs["tmax"] = tmax
+
+def _read_ahead(fn, iterable, depth=2):
+    # Like map(fn, iterable), but the calls run on a background thread up to depth items ahead
+    with ThreadPoolExecutor(1) as ex:
+        pending = deque()
+        for item in iterable:
+            pending.append(ex.submit(fn, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def extract_rois(file_, rois, tmin=None, tmax=None, index=False, projection=(), chunk_size=TYPICAL_DASK_CHUNK):
+    """
+    Write the events of file_ with tmin <= TIME < tmax inside each of rois, a list of
+    (outfile, Roi), in a single pass: every column chunk is read once and filtered for all
+    ROIs. Chunks are read, filtered and written by a pipeline of three threads. index and
+    projection select index based outputs, see _RoiWriter.
+    """
+    with ExitStack() as stack:
+        fin = stack.enter_context(h5py.File(file_, "r", swmr=True))
+        eve_in = fin["EVENTS"]
+        cols_in = columns(eve_in)
+        needed = [c for _, roi in rois for c in roi.channels] + list(projection)
+        missing = [c for c in dict.fromkeys(needed) if c not in cols_in]
+        if missing:
+            raise KeyError(f"No event data for {', '.join(missing)} in '{file_}'.")
+        writers = [
+            _RoiWriter(stack.enter_context(h5py.File(outfile, "w")), roi, fin, file_, cols_in, index, projection)
+            for outfile, roi in rois
+        ]
+        names = list(dict.fromkeys(needed + [name for w in writers for name in w.columns]))
+        index_in = eve_in["INDEX"] if index and is_indexed(eve_in) else None
+
+        def read(k):
+            slc = np.s_[k:min(k + chunk_size, stop)]
+            chunk = {name:cols_in[name][slc] for name in names}
+            idx = None
+            if index:
+                idx = index_in[slc] if index_in is not None else np.arange(slc.start, slc.stop)
+            return chunk, idx
+
+        def append(selected):
+            for w, sel in zip(writers, selected):
+                w.append(sel)
+
+        # Reading, filtering and writing overlap, with up to two chunks waiting between them
+        start, stop = time_window(eve_in, tmin, tmax)
+        with ThreadPoolExecutor(1) as writer:
+            pending = deque()
+            for chunk, idx in tqdm(_read_ahead(read, range(start, stop, chunk_size)),
+                                   total=len(range(start, stop, chunk_size)), desc="Processing"):
+                pending.append(writer.submit(append, [w.select(chunk, idx) for w in writers]))
+                if len(pending) > 2:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        for w in writers:
+            w.finalize(file_, tmin, tmax)
 
 def _parse_cli_args():
     parser = argparse.ArgumentParser(
-        description="Define a ROI and write the IDs of the included events into the HDF file."\
-                    "\nSpecify only one type of ROI at a time",
-        parents=[default_argparser]
+        description="Write the events inside a ROI into a new HDF file. Define one ROI with "\
+                    "XCHANNEL and one of --strip, --rect or --poly, or several with --roi "\
+                    "and --roi-file, which are extracted in a single pass over the events.",
+        parents=[default_argparser, time_window_argparser]
     )
     parser.add_argument(
         "xchannel",
         help="Channel for 1D ROI / X-channel for 2D ROI, e.g. ADC0, ADC1, ....",
         type=str,
+        nargs="?",
+        default="",
     )
     parser.add_argument(
         "--ychannel",
@@ -90,89 +375,85 @@ def _parse_cli_args():
         type=int,
         nargs="+"
     )
+    parser.add_argument(
+        "--roi",
+        help="A named ROI 'OUTFILE XCHANNEL[:YCHANNEL] strip|rect|poly VALUES...', e.g. "\
+             "'dr1.h5roi ADC1 strip 5500 7500'. Can be given several times.",
+        nargs="+",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--roi-file",
+        help="File with one ROI per line like --roi, lines starting with # are ignored.",
+        type=str,
+    )
+    parser.add_argument(
+        "--index",
+        help="Store the indices of the events in the ROI instead of copying their data. They "\
+             "are read from the input file on access, which has to stay next to the output.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--columns",
+        help="With --index, also copy these event columns into the output.",
+        type=str,
+        nargs="+",
+        default=[],
+    )
 
     args = parser.parse_args()
     return args
 
-def _main():
-    args = _parse_cli_args()
-    check_input(args.file)
+def _rois_from_args(args):
+    specs = list(args.roi)
+    if args.roi_file:
+        check_input(args.roi_file)
+        with open(args.roi_file) as f:
+            specs += [line.split() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    kind_of_roi = [args.strip, args.rect, args.poly]
+    if specs:
+        if args.xchannel or any(kind_of_roi) or args.out:
+            sys.exit("--roi and --roi-file can't be combined with XCHANNEL, --out and the single ROI options.")
+        if any(len(spec) < 2 for spec in specs):
+            sys.exit("Every --roi needs an output file and a ROI.")
+        rois = []
+        for spec in specs:
+            try:
+                rois.append((spec[0], parse_roi(spec[1:])))
+            except ValueError as exc:
+                sys.exit(str(exc))
+        return rois
+
+    if not args.xchannel or sum(bool(a) for a in kind_of_roi) != 1:
+        sys.exit("Choose exactly one type of ROI for XCHANNEL, or use --roi.")
+    if (args.rect or args.poly) and not args.ychannel:
+        sys.exit("2D ROIs need a --ychannel.")
     outfile = args.out
     if not outfile:
         outfile = os.path.splitext(args.file)[0] + ".h5roi"
-    check_output(outfile, args.yes)
-
-    kind_of_roi = [args.strip, args.rect, args.poly]
-    assert sum(bool(a) for a in kind_of_roi) == 1, "Choose exactly one type of ROI!"
-
-    if args.poly:
-        vx = np.array(args.poly[::2])
-        vy = np.array(args.poly[1::2])
-        _check_roi_2d_poly = _make_check_roi_2d_poly(vx, vy)
-
-    with h5py.File(args.file, "r") as fin, h5py.File(outfile, "w") as fout:
-        datafile = fin.attrs.get("datafile", None)
-        if not datafile:
-            datafile = os.path.basename(args.file)
-        fout["datafile"] = datafile
-
-        eve_in = fin["EVENTS"]
-        xchan = eve_in[args.xchannel]
-        ychan = eve_in[args.ychannel] if args.ychannel else None
-
-        fin.copy("CFG", fout)
-        eve_out = fout.create_group("EVENTS")
-        roiinf = fout.create_group("ROI")
-        for name, vec in eve_in.items():
-            stor = eve_out.create_dataset(name, (2,), maxshape=vec.shape, dtype=vec.dtype)
-
-        n = eve_in["TIME"].len()
-        chunk_size = TYPICAL_DASK_CHUNK
-        stor_pos = 0
-        for k in tqdm(range(n//chunk_size+1), desc="Processing"):
-            if (k+1)*chunk_size + 1 < n:
-                slc = np.s_[k*chunk_size:(k+1)*chunk_size + 1]
-            else:
-                slc = np.s_[k*chunk_size:]
-
-            xarr = xchan[slc]
-            if ychan:
-                yarr = ychan[slc]
-
-            if args.strip:
-                in_roi = _check_roi_1d(xarr, min(args.strip), max(args.strip))
-                kind = "1D"
-                roiargs = str(args.strip)
-
-            if args.rect:
-                in_roi = _check_roi_2d_rect(
-                    xarr, args.rect[0], args.rect[1], yarr, args.rect[2], args.rect[3]
-                )
-                kind = "2DRect"
-                roiargs = str(args.rect)
-
-            if args.poly:
-                in_roi = _check_roi_2d_poly(xarr, yarr)
-                kind = "2DPoly"
-                roiargs = str(args.rect)
-
-            for name, vec in eve_in.items():
-                stor = eve_out[name]
-                filt = vec[slc][in_roi]
-                stor.resize(stor_pos+filt.size, axis=0)
-                stor[stor_pos:stor_pos+filt.size] = filt
-            stor_pos += filt.size
-
-
-        roiinf.attrs["kind"] = kind
-        roiinf.attrs["roiargs"] = roiargs
-        roiinf.attrs["xchannel"] = args.xchannel
-        roiinf.attrs["basefile"] = os.path.basename(args.file)
-        if args.ychannel:
-            roiinf.attrs["ychannel"] = args.ychannel
+    if args.strip:
+        roi = Roi("1D", args.strip, args.xchannel)
+    elif args.rect:
+        roi = Roi("2DRect", args.rect, args.xchannel, args.ychannel)
+    else:
+        roi = Roi("2DPoly", args.poly, args.xchannel, args.ychannel)
+    return [(outfile, roi)]
 
+def _main():
+    args = _parse_cli_args()
+    check_input(args.file)
+    if args.columns and not args.index:
+        sys.exit("--columns only applies to --index outputs.")
+    rois = _rois_from_args(args)
+    for outfile, _ in rois:
+        check_output(outfile, args.yes)
+    try:
+        extract_rois(args.file, rois, args.tmin, args.tmax, args.index, args.columns)
+    except KeyError as exc:
+        sys.exit(exc.args[0])
 
     sys.exit(0)
 
 if __name__ == "__main__":
-    _main()
\ No newline at end of file
+    _main()
@@ -1,21 +1,39 @@
 """ Easy histograms from MPA data converted to HDF 5 with lst2hdf5"""
 import sys
 import os
+import re
+from importlib.util import find_spec
 
 import argparse
 
 import numpy as np
+import numba as nb
 import h5py
+from tqdm.auto import tqdm
 
+import dask
 import dask.array as da
 
 from _common import (
     INVALID_ADC_VALUE,
     TYPICAL_DASK_CHUNK,
+    DENSE_MAX_BINS,
+    SPARSE_MAX_FILL,
+    SparseCounts,
     DaskProgressBar,
     check_input,
     check_output,
     default_argparser,
+    time_window_argparser,
+)
+from events import time_window, columns, is_indexed, parent_file
+from extract_roi import parse_roi, roi_tables, in_rois_args, in_rois
+from hist_cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_CACHE_MB,
+    MAX_BASE_BINS,
+    HistogramCache,
+    rebin,
 )
 
 
@@ -30,52 +48,448 @@ def dask_hist2d(xdata, ydata, bins, range_=None):
     hist = hist.sum(axis=-1)
     return hist, ex, ey
 
-def hist2d_from_mpa_data(file_, xchannel, ychannel, nxbins=1024, nybins=1024, chunk_size=TYPICAL_DASK_CHUNK):
-    with h5py.File(file_, "r") as f:
-        config = f["CFG"]
-        xmin = 0
-        ymin = 0
-        try:
-            xmax = config[xchannel].attrs["range"]
-        except:
-            xmax = INVALID_ADC_VALUE
-        try:
-            ymax = config[ychannel].attrs["range"]
-        except:
-            ymax = INVALID_ADC_VALUE
-        events = f["EVENTS"]
-        xdata = da.from_array(events[xchannel], chunks=chunk_size)
-        ydata = da.from_array(events[ychannel], chunks=chunk_size)
-        binned, ex, ey = dask_hist2d(xdata, ydata, (nxbins, nybins),
-                                     range_=((xmin, xmax), (ymin, ymax)))
+def _h5_config(f):
+    # The channel settings in CFG, shaped like the parsed list file header
+    return {name:dict(grp.attrs) for name, grp in f["CFG"].items()} if "CFG" in f else {}
+
+def _fill_from_mpa_data(f, accs, chunk_size, tmin, tmax):
+    events = f["EVENTS"]
+    start, stop = time_window(events, tmin, tmax)
+    cols = columns(events)
+    channels = (c for acc in accs for c in acc.channels)
+    names = [name for name in dict.fromkeys(channels) if name in cols]
+    for k in tqdm(range(start, stop, chunk_size), desc="Histogram"):
+        slc = np.s_[k:min(k + chunk_size, stop)]
+        chunk = {name:cols[name][slc] for name in names}
+        for acc in accs:
+            acc.update(chunk, slc.stop - slc.start)
+
+def hists_from_mpa_data(file_, specs, chunk_size=TYPICAL_DASK_CHUNK, tmin=None, tmax=None, ranges=None,
+                        cache=None, gates=()):
+    """
+    Histograms for the specifications (xchannel, ychannel, nx, ny) in specs from a single pass
+    over the events of file_. Every column chunk is read once and fed to all histograms using
+    it. ranges maps channel names to (min, max) and overrides the ranges from CFG. With a
+    hist_cache.HistogramCache, histograms are rebinned from cached base histograms where
+    possible. Only events inside all gates (extract_roi.Rois) are counted. Returns
+    HistogramAccumulators in the order of specs, the ones of missing channels are not seen.
+    """
+    with h5py.File(file_, "r", swmr=True) as f:
+        config = _h5_config(f)
+        accs = [HistogramAccumulator(*spec, config=config, ranges=ranges, gates=gates) for spec in specs]
+        if cache is None:
+            _fill_from_mpa_data(f, accs, chunk_size, tmin, tmax)
+            return accs
+        bounds = {c:_value_bound(f, config, c) for acc in accs for c in (acc.xchannel, acc.ychannel) if c}
+        gate_specs = "; ".join(gate.spec for gate in gates)
+        keys = [cache.key(file_, acc.xchannel, acc.ychannel, tmin, tmax, gate_specs) for acc in accs]
+        bases = {key:cache.load(key) for key in set(keys)}
+        base_accs = {}
+        direct = []
+        for acc, key in zip(accs, keys):
+            if bases[key] is None:
+                xhi, xcomplete = bounds[acc.xchannel]
+                yhi, ycomplete = bounds[acc.ychannel] if acc.ychannel else (0, True)
+                if (xhi + 1)*(yhi + 1) <= MAX_BASE_BINS:
+                    if key not in base_accs:
+                        base_accs[key] = HistogramAccumulator.for_values(
+                            acc.xchannel, acc.ychannel, xhi, yhi, gates=gates
+                        )
+                    shape = (xhi + 1, yhi + 1) if acc.ychannel else (xhi + 1,)
+                    if _covers(acc, shape, xcomplete and ycomplete):
+                        continue
+            elif _covers(acc, bases[key][0].shape, bases[key][1]):
+                continue
+            direct.append(acc)
+        if base_accs or direct:
+            _fill_from_mpa_data(f, list(base_accs.values()) + direct, chunk_size, tmin, tmax)
+    for key, base_acc in base_accs.items():
+        if base_acc.seen:
+            complete = all(bounds[c][1] for c in (base_acc.xchannel, base_acc.ychannel) if c)
+            bases[key] = base_acc.sparse_counts(), complete
+            cache.store(
+                key, *bases[key], file=os.path.abspath(file_), xchannel=base_acc.xchannel,
+                ychannel=base_acc.ychannel, gates=gate_specs
+            )
+    for acc, key in zip(accs, keys):
+        if acc not in direct and bases[key] is not None:
+            acc.add_counts(rebin(bases[key][0], *_bins(acc)))
+    return accs
+
+def _value_bound(f, config, channel):
+    # Largest value the base histogram of channel has to hold and whether there are no larger ones
+    events = f["EVENTS"]
+    summary = events.get(f"SUMMARY/{channel}")
+    if summary is not None:
+        return int(summary.attrs.get("max", 0)), True
+    if is_indexed(events): # The events are a subset of the parent's
+        with h5py.File(parent_file(events), "r", swmr=True) as parent:
+            return _value_bound(parent, config, channel)
+    if channel in config and "range" in config[channel]:
+        return int(config[channel]["range"]) - 1, True # An ADC with range=N gives 0..N-1
+    return INVALID_ADC_VALUE - 1, True
+
+def _bins(acc):
+    bins = [(acc.xlut, acc.ex.size - 1)]
+    if acc.ychannel:
+        bins.append((acc.ylut, acc.ey.size - 1))
+    return bins
+
+def _covers(acc, shape, complete):
+    # Whether a base histogram of shape has all values that fall into the bins of acc
+    return complete or all((lut[n:] < 0).all() for (lut, _), n in zip(_bins(acc), shape))
+
+def _hist_from_mpa_data(file_, xchannel, ychannel, nxbins, nybins, chunk_size, tmin, tmax, ranges, cache,
+                        gates):
+    with h5py.File(file_, "r", swmr=True) as f:
+        channels = [xchannel, ychannel] + [c for gate in gates for c in gate.channels]
+        missing = [c for c in dict.fromkeys(channels) if c and c not in columns(f["EVENTS"])]
+    if missing:
+        raise KeyError(f"No event data for {', '.join(missing)} in '{file_}'.")
+    specs = [(xchannel, ychannel, nxbins, nybins)]
+    return hists_from_mpa_data(file_, specs, chunk_size, tmin, tmax, ranges, cache, gates)[0]
+
+def _chunk_hist(file_, xchannel, ychannel, start, stop, ex, ey):
+    # Runs on the dask workers, every task opens the file itself and reads its own slice
+    with h5py.File(file_, "r", swmr=True) as f:
+        cols = columns(f["EVENTS"])
+        x = cols[xchannel][start:stop]
+        if not ychannel:
+            return np.histogram(x[x != INVALID_ADC_VALUE], ex)[0]
+        y = cols[ychannel][start:stop]
+    valid = (x != INVALID_ADC_VALUE) & (y != INVALID_ADC_VALUE)
+    return np.histogram2d(x[valid], y[valid], (ex, ey))[0].astype(np.int64)
+
+def _dask_hist_from_mpa_data(file_, xchannel, ychannel, nxbins, nybins, chunk_size, tmin, tmax, ranges,
+                             scheduler, workers):
+    with h5py.File(file_, "r", swmr=True) as f:
+        config = _h5_config(f)
+        missing = [c for c in (xchannel, ychannel) if c and c not in columns(f["EVENTS"])]
+        start, stop = time_window(f["EVENTS"], tmin, tmax)
+    if missing:
+        raise KeyError(f"No event data for {', '.join(missing)} in '{file_}'.")
+    default = INVALID_ADC_VALUE if ychannel else INVALID_ADC_VALUE - 1
+    ex = np.linspace(*_channel_range(config, ranges, xchannel, default), nxbins + 1)
+    ey = np.linspace(*_channel_range(config, ranges, ychannel, default), nybins + 1) if ychannel else None
+    shape = (nxbins, nybins) if ychannel else (nxbins,)
+    chunk_hist = dask.delayed(_chunk_hist, pure=True)
+    parts = [
+        da.from_delayed(
+            chunk_hist(file_, xchannel, ychannel, k, min(k + chunk_size, stop), ex, ey), shape, dtype=np.int64
+        ) for k in range(start, stop, chunk_size)
+    ]
+    binned = da.stack(parts).sum(axis=0) if parts else da.zeros(shape, dtype=np.int64)
+    if scheduler == "distributed":
+        from distributed import Client, LocalCluster, progress
+        with LocalCluster(n_workers=workers, threads_per_worker=1) as cluster, Client(cluster) as client:
+            future = client.compute(binned)
+            progress(future)
+            binned = future.result()
+    else:
         with DaskProgressBar():
-            binned = binned.compute()
+            binned = binned.compute(scheduler=scheduler, num_workers=workers)
     return binned, ex, ey
 
-def hist1d_from_mpa_data(file_, xchannel, nxbins=1024, chunk_size=TYPICAL_DASK_CHUNK):
-    with h5py.File(file_, "r") as f:
-        config = f["CFG"]
-        xmin = 0
-        try:
-            xmax = config[xchannel].attrs["range"]
-        except:
-            xmax = INVALID_ADC_VALUE - 1
-        events = f["EVENTS"]
-        xdata = da.from_array(events[xchannel], chunks=chunk_size)
-        binned, ex = da.histogram(xdata, nxbins, range=(xmin, xmax))
-        with DaskProgressBar():
-            binned = binned.compute()
+def hist2d_from_mpa_data(file_, xchannel, ychannel, nxbins=1024, nybins=1024, chunk_size=TYPICAL_DASK_CHUNK,
+                         tmin=None, tmax=None, engine="numba", ranges=None, cache=None, scheduler="threads",
+                         workers=None, gates=()):
+    """
+    2D histogram of xchannel and ychannel of the events in file_ with the numba engine or
+    with dask, which runs on the given scheduler ("threads", "processes" or a local
+    "distributed" cluster) with workers workers. Gates are only supported by numba.
+    """
+    if engine == "numba":
+        acc = _hist_from_mpa_data(
+            file_, xchannel, ychannel, nxbins, nybins, chunk_size, tmin, tmax, ranges, cache, gates
+        )
+        return acc.counts, acc.ex, acc.ey
+    if gates:
+        raise ValueError("Gates are only supported by the numba engine.")
+    return _dask_hist_from_mpa_data(
+        file_, xchannel, ychannel, nxbins, nybins, chunk_size, tmin, tmax, ranges, scheduler, workers
+    )
+
+def hist1d_from_mpa_data(file_, xchannel, nxbins=1024, chunk_size=TYPICAL_DASK_CHUNK, tmin=None, tmax=None,
+                         engine="numba", ranges=None, cache=None, scheduler="threads", workers=None, gates=()):
+    if engine == "numba":
+        acc = _hist_from_mpa_data(
+            file_, xchannel, "", nxbins, 0, chunk_size, tmin, tmax, ranges, cache, gates
+        )
+        return acc.counts, acc.ex
+    if gates:
+        raise ValueError("Gates are only supported by the numba engine.")
+    binned, ex, _ = _dask_hist_from_mpa_data(
+        file_, xchannel, "", nxbins, 0, chunk_size, tmin, tmax, ranges, scheduler, workers
+    )
     return binned, ex
 
+def parse_hist_spec(spec):
+    """
+    Parse a histogram specification 'XCHANNEL[:YCHANNEL][@NX[xNY]]', e.g. 'ADC1', 'ADC2:ADC1'
+    or 'ADC2:ADC3@512x256'. Returns xchannel, ychannel ('' for 1D histograms), nx and ny.
+    """
+    m = re.match(r"^(\w+)(?::(\w+))?(?:@(\d+)(?:x(\d+))?)?$", spec)
+    if not m:
+        raise argparse.ArgumentTypeError(f"Invalid histogram specification '{spec}'.")
+    nx = int(m[3]) if m[3] else 1024
+    ny = int(m[4]) if m[4] else nx if m[3] else 1024
+    return m[1], m[2] or "", nx, ny
+
+def parse_hist_output_spec(spec):
+    """
+    Parse 'SPEC[=OUTFILE]' with SPEC as in parse_hist_spec. Returns the parsed SPEC and
+    OUTFILE ('' for the default name).
+    """
+    spec, _, outfile = spec.partition("=")
+    return parse_hist_spec(spec), outfile
+
+def hist_file_name(base, xchannel, ychannel=""):
+    if ychannel:
+        return f"{base}_{xchannel}_{ychannel}.h5hist"
+    return f"{base}_{xchannel}.h5hist"
+
+def _channel_max(config, channel, default):
+    try:
+        return config[channel]["range"]
+    except KeyError:
+        return default
+
+def _channel_range(config, ranges, channel, default):
+    if ranges and channel in ranges:
+        return tuple(ranges[channel])
+    return (0, _channel_max(config, channel, default))
+
+def _bin_lut(edges):
+    """
+    The bin of every uint16 value for the given edges, binned like np.histogram. Values outside
+    the edges and INVALID_ADC_VALUE map to -1.
+    """
+    values = np.arange(INVALID_ADC_VALUE + 1)
+    lut = np.searchsorted(edges, values, side="right") - 1
+    lut[values == edges[-1]] = edges.size - 2 # The last bin includes its right edge
+    lut[(values < edges[0]) | (values > edges[-1])] = -1
+    lut[INVALID_ADC_VALUE] = -1
+    return lut.astype(np.int32)
+
+def _n_partitions(n_bins):
+    # One private histogram per thread, as long as they stay below 128 MB in total
+    return max(1, min(nb.get_num_threads(), (1 << 27)//(8*n_bins)))
+
+@nb.njit(cache=True, parallel=True)
+def _hist1d_kernel(x, xlut, partial,
+                   strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+    # Every partition of the data is counted into its own row of partial, no atomics needed.
+    # Only events inside the gates (extract_roi.in_rois) are counted.
+    n_part = partial.shape[0]
+    step = (x.size + n_part - 1)//n_part
+    for p in nb.prange(n_part):
+        for i in range(p*step, min((p + 1)*step, x.size)):
+            if not in_rois(i, strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+                continue
+            bx = xlut[x[i]]
+            if bx >= 0:
+                partial[p, bx] += 1
+
+@nb.njit(cache=True, parallel=True)
+def _hist2d_kernel(x, y, xlut, ylut, partial,
+                   strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+    n_part = partial.shape[0]
+    step = (x.size + n_part - 1)//n_part
+    for p in nb.prange(n_part):
+        for i in range(p*step, min((p + 1)*step, x.size)):
+            if not in_rois(i, strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+                continue
+            bx = xlut[x[i]]
+            by = ylut[y[i]]
+            if bx >= 0 and by >= 0:
+                partial[p, bx, by] += 1
+
+@nb.njit(cache=True, nogil=True)
+def _flat_bins2d(x, y, xlut, ylut, ny, out,
+                 strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+    # Writes the flat bin index of the counted events to out, returns their number
+    n = 0
+    for i in range(x.size):
+        if not in_rois(i, strip_x, strip_lut, box_x, box_y, box_bits, box_x0, box_y0):
+            continue
+        bx = xlut[x[i]]
+        by = ylut[y[i]]
+        if bx >= 0 and by >= 0:
+            out[n] = bx*ny + by
+            n += 1
+    return n
+
+def _merge_flat(keys, vals):
+    # Sum up the values of equal keys, returns sorted unique keys
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=vals, minlength=keys.size).astype(np.int64)
+
+class HistogramAccumulator:
+    """
+    Accumulates a 1D or 2D histogram of integer ADC data chunk by chunk. config maps channel
+    names to their settings (e.g. the parsed list file header), it provides the histogram
+    ranges unless ranges maps the channel to its own (min, max). The bin of every ADC value is
+    looked up in a table, numba threads count into private int64 histograms which are summed
+    up by counts. Events without a value (INVALID_ADC_VALUE) are not counted, nor are events
+    outside of any of the gates (extract_roi.Rois), which the kernels test while binning. 2D
+    histograms with more than DENSE_MAX_BINS bins are accumulated sparse, counts is a
+    SparseCounts then.
+    """
+    def __init__(self, xchannel, ychannel="", nxbins=1024, nybins=1024, config=None, ranges=None,
+                 gates=()):
+        config = config or {}
+        self.xchannel = xchannel
+        self.ychannel = ychannel
+        self.gates = list(gates)
+        self._gate_tables = roi_tables(self.gates)
+        self.seen = False
+        if ychannel:
+            self.xrange = _channel_range(config, ranges, xchannel, INVALID_ADC_VALUE)
+            self.yrange = _channel_range(config, ranges, ychannel, INVALID_ADC_VALUE)
+            self.ex = np.linspace(*self.xrange, nxbins + 1)
+            self.ey = np.linspace(*self.yrange, nybins + 1)
+            self.ylut = _bin_lut(self.ey)
+            self.shape = (nxbins, nybins)
+        else:
+            self.xrange = _channel_range(config, ranges, xchannel, INVALID_ADC_VALUE - 1)
+            self.ex = np.linspace(*self.xrange, nxbins + 1)
+            self.ey = None
+            self.shape = (nxbins,)
+        self.xlut = _bin_lut(self.ex)
+        self.sparse = np.prod(self.shape) > DENSE_MAX_BINS
+        if self.sparse:
+            self._keys = np.empty(0, dtype=np.int64)
+            self._vals = np.empty(0, dtype=np.int64)
+            self._pending = []
+            self._buffer = np.empty(0, dtype=np.int64)
+        else:
+            self._partial = np.zeros((_n_partitions(np.prod(self.shape)),) + self.shape, dtype=np.int64)
+
+    @classmethod
+    def for_values(cls, xchannel, ychannel="", xhi=INVALID_ADC_VALUE - 1, yhi=INVALID_ADC_VALUE - 1, gates=()):
+        """A histogram with one bin per ADC value 0...xhi (and 0...yhi), larger values are not counted."""
+        ranges = {xchannel:(0, xhi + 1), ychannel:(0, yhi + 1)}
+        acc = cls(xchannel, ychannel, xhi + 1, yhi + 1, ranges=ranges, gates=gates)
+        acc.xlut[xhi + 1:] = -1
+        if ychannel:
+            acc.ylut[yhi + 1:] = -1
+        return acc
+
+    @property
+    def channels(self):
+        """All channels needed to fill the histogram, including the ones of the gates."""
+        return list(dict.fromkeys(
+            [c for c in (self.xchannel, self.ychannel) if c] + [c for g in self.gates for c in g.channels]
+        ))
+
+    @property
+    def counts(self):
+        if self.sparse:
+            return self.sparse_counts()
+        return self._partial.sum(axis=0)
+
+    def sparse_counts(self):
+        if not self.sparse:
+            return SparseCounts.from_dense(self.counts)
+        self._merge()
+        dtype = np.uint16 if max(self.shape) <= 1 << 16 else np.uint32
+        index = np.array(np.unravel_index(self._keys, self.shape), dtype=dtype)
+        return SparseCounts(self.shape, index, self._vals)
+
+    def _merge(self):
+        if self._pending:
+            keys, vals = zip(*self._pending)
+            self._keys, self._vals = _merge_flat(
+                np.concatenate((self._keys,) + keys), np.concatenate((self._vals,) + vals)
+            )
+            self._pending = []
+
+    def _add_flat(self, keys, vals):
+        self._pending.append((keys, vals))
+        if sum(k.size for k, _ in self._pending) > 4*max(self._keys.size, 1 << 20):
+            self._merge()
+
+    def add_counts(self, counts):
+        """
+        Add counts (an array or SparseCounts) binned like this histogram, e.g. rebinned from a
+        cached base histogram.
+        """
+        self.seen = True
+        if self.sparse:
+            if not isinstance(counts, SparseCounts):
+                counts = SparseCounts.from_dense(counts)
+            self._add_flat(np.ravel_multi_index(tuple(counts.index), self.shape), counts.count)
+        elif isinstance(counts, SparseCounts):
+            self._partial[0][tuple(counts.index)] += counts.count
+        else:
+            self._partial[0] += counts
+
+    def update(self, columns, n):
+        """Add n events, columns maps channel names to data, missing channels have no data."""
+        self.seen |= self.xchannel in columns or self.ychannel in columns
+        x = columns.get(self.xchannel)
+        y = columns.get(self.ychannel)
+        if x is None or self.ychannel and y is None:
+            return
+        if any(c not in columns for c in self.channels): # No events inside a gate without data
+            return
+        gates = in_rois_args(self.gates, self._gate_tables, columns)
+        if self.sparse:
+            if self._buffer.size < x.size:
+                self._buffer = np.empty(x.size, dtype=np.int64)
+            n_count = _flat_bins2d(x, y, self.xlut, self.ylut, self.shape[1], self._buffer, *gates)
+            keys, vals = np.unique(self._buffer[:n_count], return_counts=True)
+            self._add_flat(keys, vals.astype(np.int64))
+        elif self.ychannel:
+            _hist2d_kernel(x, y, self.xlut, self.ylut, self._partial, *gates)
+        else:
+            _hist1d_kernel(x, self.xlut, self._partial, *gates)
+
+def write_h5hist(outfile, hist, ex, ey=None, xchannel="", ychannel="", datafile="", basefile="",
+                 storage="auto", gates=()):
+    """
+    Write the counts hist (an array or SparseCounts) with its edges. storage is "dense",
+    "sparse" (the indices and counts of the non-empty bins) or "auto", which stores 2D
+    histograms sparse if less than SPARSE_MAX_FILL of their bins are filled. gates are the
+    specifications of the ROIs the events were gated with.
+    """
+    kind = "2D" if ey is not None else "1D"
+    is_sparse = isinstance(hist, SparseCounts)
+    if storage == "auto":
+        fill = hist.fill if is_sparse else np.count_nonzero(hist)/max(hist.size, 1)
+        storage = "sparse" if kind == "2D" and fill < SPARSE_MAX_FILL else "dense"
+    with h5py.File(outfile, "w") as f:
+        f.attrs["datafile"] = datafile
+        f.attrs["basefile"] = basefile
+        f.attrs["kind"] = kind
+        f.attrs["xchannel"] = xchannel
+        f.attrs["storage"] = storage
+        if gates:
+            f.attrs["gates"] = "; ".join(gates)
+        f.create_dataset("EX", data=ex)
+        if storage == "sparse":
+            hist = hist if is_sparse else SparseCounts.from_dense(hist)
+            f.attrs["shape"] = hist.shape
+            f.create_dataset("HIST_INDEX", data=hist.index, compression="gzip", shuffle=True)
+            f.create_dataset("HIST_COUNT", data=hist.count, compression="gzip", shuffle=True)
+        else:
+            f.create_dataset("HIST", data=hist.toarray() if is_sparse else hist)
+        if kind == "2D":
+            f.attrs["orientation"] = "x = dim0/rows, y = dim1/cols"
+            f.attrs["ychannel"] = ychannel
+            f.create_dataset("EY", data=ey)
+
 def _parse_cli_args():
     parser = argparse.ArgumentParser(
         description="Make a histogram from MPA data in HDF5 format.",
-        parents=[default_argparser]
+        parents=[default_argparser, time_window_argparser]
     )
     parser.add_argument(
         "xchannel",
-        help="Channel on the x-axis, e.g. ADC0, ADC1, ....",
+        help="Channel on the x-axis, e.g. ADC0, ADC1, .... Not needed with --hist.",
         type=str,
+        nargs="?",
+        default="",
     )
     parser.add_argument(
         "--nx",
@@ -95,41 +509,159 @@ def _parse_cli_args():
         type=int,
         default=1024,
     )
+    parser.add_argument(
+        "--engine",
+        help="Histogram with numba threads over integer bins (default) or with dask.",
+        choices=["numba", "dask"],
+        default="numba",
+    )
+    parser.add_argument(
+        "--scheduler",
+        help="Scheduler of the dask engine, every task opens the file itself and reads its own "\
+             "chunk.",
+        choices=["threads", "processes", "distributed"],
+        default="threads",
+    )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        help="Number of dask workers, defaults to the number of CPUs.",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Number of events read and histogrammed at once.",
+        type=int,
+        default=TYPICAL_DASK_CHUNK,
+    )
+    parser.add_argument(
+        "--hist",
+        help="Make several histograms in a single pass over the events instead of one for "\
+             "XCHANNEL, each 'XCHANNEL[:YCHANNEL][@NX[xNY]][=OUTFILE]', e.g. ADC1 ADC2:ADC1@512. "\
+             "OUTFILE defaults to <file>_ADC2_ADC1.h5hist.",
+        type=parse_hist_output_spec,
+        nargs="+",
+        default=[],
+    )
+    parser.add_argument(
+        "--range",
+        help="Histogram range of CHANNEL, overrides the range from the ADC settings. "\
+             "Can be given several times.",
+        nargs=3,
+        metavar=("CHANNEL", "MIN", "MAX"),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--gate",
+        help="Only count the events inside a ROI 'XCHANNEL[:YCHANNEL] strip|rect|poly VALUES...' "\
+             "like extract_roi --roi without OUTFILE, e.g. 'ADC1 strip 5500 7500'. Can be given "\
+             "several times, events have to be inside all of them.",
+        nargs="+",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--storage",
+        help="Store HIST dense, sparse (indices and counts of the non-empty bins) or pick by the "\
+             "fill factor (default, only 2D histograms are ever stored sparse).",
+        choices=["auto", "dense", "sparse"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Keep full resolution histograms in DIR (default %(const)s) and derive other "\
+             "binnings from them without reading the events again.",
+        nargs="?",
+        const=DEFAULT_CACHE_DIR,
+        default="",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Size limit of the cache in MB, the least recently used histograms are evicted.",
+        type=float,
+        default=DEFAULT_CACHE_MB,
+    )
     args = parser.parse_args()
     return args
 
+def _datafile(file_):
+    with h5py.File(file_, "r", swmr=True) as f:
+        datafile = f.attrs.get("datafile", None)
+    return datafile or os.path.basename(file_)
+
+def _main_multi(args, ranges, cache, gates):
+    base = os.path.splitext(args.file)[0]
+    outfiles = [out or hist_file_name(base, *spec[:2]) for spec, out in args.hist]
+    for outfile in outfiles:
+        check_output(outfile, args.yes)
+    accs = hists_from_mpa_data(
+        args.file, [spec for spec, _ in args.hist], chunk_size=args.chunk_size, tmin=args.tmin,
+        tmax=args.tmax, ranges=ranges, cache=cache, gates=gates
+    )
+    datafile = _datafile(args.file)
+    missing = False
+    for acc, outfile in zip(accs, outfiles):
+        if not acc.seen:
+            print(f"No event data for the {outfile} histogram, skipped.", file=sys.stderr)
+            missing = True
+            continue
+        write_h5hist(
+            outfile, acc.counts, acc.ex, acc.ey, xchannel=acc.xchannel, ychannel=acc.ychannel,
+            datafile=datafile, basefile=os.path.basename(args.file), storage=args.storage,
+            gates=[gate.spec for gate in gates]
+        )
+    sys.exit(1 if missing else 0)
+
 def _main():
     args = _parse_cli_args()
     check_input(args.file)
+    if bool(args.xchannel) == bool(args.hist):
+        sys.exit("Give either XCHANNEL or --hist.")
+    try:
+        ranges = {ch:(float(lo), float(hi)) for ch, lo, hi in args.range}
+    except ValueError:
+        sys.exit("--range needs numbers for MIN and MAX.")
+    if args.engine != "numba" and (args.cache or args.gate):
+        sys.exit("--cache and --gate are only supported by the numba engine.")
+    try:
+        gates = [parse_roi(tokens) for tokens in args.gate]
+    except ValueError as exc:
+        sys.exit(str(exc))
+    if args.engine == "dask" and args.scheduler == "distributed" and find_spec("distributed") is None:
+        sys.exit("--scheduler distributed needs the distributed package.")
+    cache = HistogramCache(args.cache, args.cache_size*1e6) if args.cache else None
+    if args.hist:
+        if args.engine != "numba" or args.out:
+            sys.exit("--hist always uses the numba engine and names its outputs itself.")
+        _main_multi(args, ranges, cache, gates)
+
     outfile = args.out
     if not outfile:
         outfile = os.path.splitext(args.file)[0] + ".h5hist"
     check_output(outfile, args.yes)
 
     if not args.ychannel:
-        hist, ex = hist1d_from_mpa_data(args.file, args.xchannel, nxbins=args.nx)
-        kind = "1D"
+        hist, ex = hist1d_from_mpa_data(
+            args.file, args.xchannel, nxbins=args.nx, chunk_size=args.chunk_size, tmin=args.tmin,
+            tmax=args.tmax, engine=args.engine, ranges=ranges, cache=cache, scheduler=args.scheduler,
+            workers=args.workers, gates=gates
+        )
+        ey = None
     else:
-        hist, ex, ey = hist2d_from_mpa_data(args.file, args.xchannel, args.ychannel, nxbins=args.nx, nybins=args.ny)
-        kind = "2D"
-
-    with h5py.File(args.file, "r") as f:
-        datafile = f.attrs.get("datafile", None)
-    if not datafile:
-        datafile = os.path.basename(args.file)
-
-    with h5py.File(outfile, "w") as f:
-        f.attrs["datafile"] = datafile
-        f.attrs["basefile"] = os.path.basename(args.file)
-        f.attrs["kind"] = kind
-        f.attrs["xchannel"] = args.xchannel
-        f.create_dataset("EX", data=ex)
-        f.create_dataset("HIST", data=hist)
-        if kind == "2D":
-            f.attrs["orientation"] = "x = dim0/rows, y = dim1/cols"
-            f.attrs["ychannel"] = args.ychannel
-            f.create_dataset("EY", data=ey)
+        hist, ex, ey = hist2d_from_mpa_data(
+            args.file, args.xchannel, args.ychannel, nxbins=args.nx, nybins=args.ny,
+            chunk_size=args.chunk_size, tmin=args.tmin, tmax=args.tmax, engine=args.engine,
+            ranges=ranges, cache=cache, scheduler=args.scheduler, workers=args.workers, gates=gates
+        )
 
+    write_h5hist(
+        outfile, hist, ex, ey, xchannel=args.xchannel, ychannel=args.ychannel,
+        datafile=_datafile(args.file), basefile=os.path.basename(args.file), storage=args.storage,
+        gates=[gate.spec for gate in gates]
+    )
 
     sys.exit(0)
 
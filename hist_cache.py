@@ -0,0 +1,120 @@
+"""
+On-disk cache of full resolution histograms for generate_hist.
+
+An entry holds the base histogram of one or two channels of an event file with one bin per
+ADC value, stored sparse as the indices and counts of its non-empty bins (SparseCounts),
+since most value pairs of 2D histograms never occur. Any coarser binning of the same data is
+derived from it by summing up the values of every bin (rebin), without reading the events
+again. Entries are named after a hash of the path, size and modification time of the event
+file, the channels, the time window and the gates, so a rewritten file never hits a stale
+entry. The least recently used entries are evicted once the cache grows beyond its size
+limit.
+"""
+import os
+import glob
+import hashlib
+
+import numpy as np
+import h5py
+
+from _common import (
+    DENSE_MAX_BINS,
+    SparseCounts,
+)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mpa_hist"
+)
+DEFAULT_CACHE_MB = 2048
+MAX_BASE_BINS = 1 << 26 # 512 MB of int64 counts, e.g. 8192 x 8192 ADC values
+
+
+class HistogramCache:
+    """
+    Base histograms stored as HDF5 files in directory, limited to max_bytes in total. load
+    marks an entry as recently used, store evicts the least recently used entries.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MB*1e6):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(file_, xchannel, ychannel="", tmin=None, tmax=None, gates=""):
+        st = os.stat(file_)
+        token = f"{os.path.abspath(file_)}|{st.st_size}|{st.st_mtime_ns}|{xchannel}|{ychannel}|{tmin}|{tmax}"
+        if gates:
+            token += f"|{gates}"
+        return hashlib.sha1(token.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".h5")
+
+    def load(self, key):
+        """The sparse base histogram for key and whether it holds all values, None if not cached."""
+        path = self._path(key)
+        try:
+            with h5py.File(path, "r") as f:
+                base = SparseCounts(f.attrs["shape"], f["INDEX"][:], f["COUNT"][:])
+                complete = bool(f.attrs["complete"])
+        except (OSError, KeyError):
+            return None
+        os.utime(path) # Mark as recently used
+        return base, complete
+
+    def store(self, key, base, complete, **attrs):
+        """
+        Store the base histogram (SparseCounts), complete tells whether it holds all values of the data
+        or only those up to its shape. Further attrs are kept for reference.
+        """
+        path = self._path(key)
+        tmp = path + ".tmp" # Never leave a half written entry behind
+        with h5py.File(tmp, "w") as f:
+            f.attrs["shape"] = base.shape
+            f.attrs["complete"] = complete
+            for name, value in attrs.items():
+                f.attrs[name] = value
+            f.create_dataset("INDEX", data=base.index, compression="gzip", shuffle=True)
+            f.create_dataset("COUNT", data=base.count, compression="gzip", shuffle=True)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.h5")):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError: # Evicted by a concurrent process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def rebin(base, *bins):
+    """
+    Sum the base histogram (SparseCounts, one bin per value) into coarser bins. bins holds a
+    pair (lut, n_bins) per axis, lut is the bin of every value like generate_hist._bin_lut, -1
+    for values outside of the histogram. Results with more than DENSE_MAX_BINS bins are
+    returned as SparseCounts.
+    """
+    keep = np.ones(base.nnz, dtype=bool)
+    flat = np.zeros(base.nnz, dtype=np.int64)
+    for (lut, n_bins), values in zip(bins, base.index):
+        b = lut[values]
+        keep &= b >= 0
+        flat = flat*n_bins + b
+    shape = tuple(n_bins for _, n_bins in bins)
+    if np.prod(shape) > DENSE_MAX_BINS:
+        keys, inverse = np.unique(flat[keep], return_inverse=True)
+        count = np.bincount(inverse, weights=base.count[keep], minlength=keys.size).astype(np.int64)
+        return SparseCounts(shape, np.array(np.unravel_index(keys, shape), dtype=base.index.dtype), count)
+    out = np.bincount(flat[keep], weights=base.count[keep], minlength=int(np.prod(shape)))
+    return out.astype(np.int64).reshape(shape)
@@ -9,6 +9,7 @@ import matplotlib.colors as mpc
 
 from _common import (
     PLOT_LABEL_ADC_TO_PHYS,
+    SparseCounts,
 )
 
 
@@ -38,7 +39,7 @@ class Histogram:
             self.pex = self.pcx = self.pey = self.pcy = None
 
     @classmethod
-    def from_h5hist(cls, file_, metafile=None):
+    def from_h5hist(cls, file_, metafile=None, sparse=False):
         with h5py.File(file_, "r") as f:
             attrs = {k:v for k, v in f.attrs.items()}
             ex = f["EX"][:]
@@ -46,7 +47,12 @@ class Histogram:
                 ey = f["EY"][:]
             else:
                 ey = None
-            counts = f["HIST"][:]
+            if attrs.get("storage", "dense") == "sparse":
+                counts = SparseCounts(attrs["shape"], f["HIST_INDEX"][:], f["HIST_COUNT"][:])
+                if not sparse: # Keep handing arrays to the fitting and plotting code
+                    counts = counts.toarray()
+            else:
+                counts = f["HIST"][:]
         if metafile is None:
             dirname = os.path.dirname(file_)
             fname = attrs["datafile"].replace("h5", "meta")
@@ -59,6 +65,13 @@ class Histogram:
             meta=None
         return cls(counts, ex, ey=ey, attrs=attrs, meta=meta)
 
+    @property
+    def is_sparse(self):
+        return isinstance(self.counts, SparseCounts)
+
+    def dense_counts(self):
+        return self.counts.toarray() if self.is_sparse else self.counts
+
     def scale_adc2phys(self, arr, axis):
         if axis == "x":
             adc = self._xchan
@@ -116,7 +129,7 @@ def hist2d(histogram, scaling="log", ax=None, vmin=1, vmax=None, clabel=True, st
         ex, ey = histogram.ex, histogram.ey
     elif style == "phys":
         ex, ey = histogram.pex, histogram.pey
-    counts = histogram.counts
+    counts = histogram.dense_counts()
 
     cmap = copy(plt.cm.plasma)
     cmap.set_under("w", 0)
@@ -180,14 +193,14 @@ def hist1d(histogram, scaling="log", ax=None, style="both"):
     else:
         fig = ax.figure
     if style == "adc" or style == "both":
-        ax.step(histogram.ex[:-1], histogram.counts, where='post')
+        ax.step(histogram.ex[:-1], histogram.dense_counts(), where='post')
         ax.set(
             xlabel=histogram._xchan,
             ylabel="Counts",
             yscale=scaling,
         )
     elif style == "phys":
-        ax.step(histogram.pex[:-1], histogram.counts, where='post')
+        ax.step(histogram.pex[:-1], histogram.dense_counts(), where='post')
         ax.set(
             xlabel=PLOT_LABEL_ADC_TO_PHYS[histogram._xchan],
             ylabel="Counts",
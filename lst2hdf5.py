@@ -4,37 +4,169 @@ Script for converting MPA-3 lst files into HDF5 files using h5py.
 import os
 import sys
 import re
+import io
+import gzip
+import bz2
+import lzma
 import argparse
+from contextlib import nullcontext
+from time import monotonic, sleep
+from queue import LifoQueue
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import numba as nb
 from tqdm import tqdm
 import h5py
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from _common import (
     INVALID_ADC_VALUE,
     LST_FILE_APPROX_CHUNK,
+    TYPICAL_DASK_CHUNK,
     default_argparser,
+    event_layout_argparser,
+    event_layout,
+    event_layout_from_args,
+    event_columns,
     check_input,
     check_output,
 )
+from generate_hist import (
+    HistogramAccumulator,
+    parse_hist_spec,
+    hist_file_name,
+    write_h5hist,
+)
+from events import (
+    COMPACT_BLOCK,
+    encode_block,
+    encode_buffer_size,
+    column_names,
+)
 
 FLAG_LISTDATA = "[LISTDATA]"
 BINFLAG_TIMER_LITTLE_ENDIAN = b"\x00\x40"
+TIMER_FLAG = np.frombuffer(BINFLAG_TIMER_LITTLE_ENDIAN, dtype="<u2")[0]
 SYNCFLAG = np.array([0xffff, 0xffff], dtype="u2")
+COMPRESSED_SUFFIXES = [".gz", ".bz2", ".xz", ".zst"]
 
 
 def _main():
     parser = argparse.ArgumentParser(
         description="Convert an MPA-3 list file into HDF5 format.",
-        parents=[default_argparser]
+        parents=[default_argparser, event_layout_argparser]
+    )
+    parser.add_argument(
+        "--prescan",
+        help="Explore the list file in a separate pass before converting it. "\
+             "Reads the file twice but writes fixed-size datasets.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--reader",
+        help="How to read the list data, memory mapped (default), with buffered reads or as a "\
+             "sequential stream. Compressed list files (.gz, .bz2, .xz, .zst) are always streamed.",
+        choices=["mmap", "read", "stream"],
+        default="mmap"
+    )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        help="Number of threads decoding list data segments concurrently.",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--follow",
+        "-f",
+        help="Follow a list file that is still being recorded and append new events as they "\
+             "arrive. The output is written in SWMR mode and can be read concurrently.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        help="Seconds between checks for new data in follow mode.",
+        type=float,
+        default=1.
+    )
+    parser.add_argument(
+        "--follow-timeout",
+        help="Stop following once the list file has not grown for this many seconds.",
+        type=float,
+        default=60.
+    )
+    parser.add_argument(
+        "--hist",
+        help="Accumulate a histogram while converting, 'XCHANNEL[:YCHANNEL][@NX[xNY]]', e.g. "\
+             "ADC1 or ADC2:ADC1. Written next to the output as <out>_ADC2_ADC1.h5hist. "\
+             "May be given multiple times.",
+        type=parse_hist_spec,
+        action="append",
+        default=[]
+    )
+    parser.add_argument(
+        "--no-events",
+        help="Only write the histograms requested with --hist, not the event file.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--compact",
+        help="Store the events with the compact codec: delta encoded TIME and bit-packed ADC "\
+             "values with presence masks. Read transparently by generate_hist and extract_roi.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted conversion from the last checkpoint recorded in the output.",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        help="Seconds between checkpoints of the conversion progress in the output.",
+        type=float,
+        default=60.
     )
     args = parser.parse_args()
     fin = check_input(args.file)
     fout = args.out
     if not fout:
-        fout = fin.replace(".lst", ".h5")
-    fout = check_output(fout, args.yes)
-    convert(fin, fout)
+        fout = strip_compression_suffix(fin).replace(".lst", ".h5")
+    if args.no_events and not args.hist:
+        sys.exit("Nothing to do, --no-events requires at least one --hist.")
+    if args.follow and (args.hist or args.no_events):
+        sys.exit("Histograms can not be accumulated in follow mode.")
+    if args.follow and is_compressed(fin):
+        sys.exit("Compressed list files can not be followed.")
+    if args.resume and (args.follow or args.hist or args.no_events):
+        sys.exit("--resume only works for plain conversions to an event file.")
+    if args.compact and (args.follow or args.resume or args.no_events):
+        sys.exit("--compact can not be combined with --follow, --resume or --no-events.")
+    if args.resume and os.path.exists(fout):
+        checkpoint = read_checkpoint(fout)
+        if checkpoint is None:
+            sys.exit(f"'{fout}' has no checkpoint to resume from.")
+        if checkpoint["complete"]:
+            print(f"'{fout}' is complete already.")
+            sys.exit(0)
+    elif not args.no_events:
+        check_output(fout, args.yes)
+    for xchannel, ychannel, _, _ in args.hist:
+        check_output(hist_file_name(os.path.splitext(fout)[0], xchannel, ychannel), args.yes)
+    layout = event_layout_from_args(args)
+    if args.follow:
+        follow(fin, fout, poll_interval=args.poll_interval, idle_timeout=args.follow_timeout,
+               layout=layout)
+    else:
+        convert(fin, fout, single_pass=not args.prescan, reader=args.reader, workers=args.workers,
+                layout=layout, hists=args.hist, write_events=not args.no_events,
+                resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+                compact=args.compact)
     sys.exit(0)
 
 def _read_header(f):
@@ -112,18 +244,154 @@ def _array_from_binary_chunk(chnk):
     arr = arr.reshape((arr.size//2, 2))
     return arr
 
-@nb.njit(cache=True)
+def _iter_read_chunks(f, filesize, approx_bytes=LST_FILE_APPROX_CHUNK):
+    while True:
+        chnk = _read_binary_chunk(f, filesize, approx_bytes)
+        yield _array_from_binary_chunk(chnk), f.tell()
+        if f.tell() == filesize:
+            break
+
+def _next_timer_index(arr, start):
+    """Index of the first timer word in arr at or after start, arr.shape[0] if there is none."""
+    window = 1 << 12
+    while start < arr.shape[0]:
+        hits = np.flatnonzero(arr[start:start+window, 1] == TIMER_FLAG)
+        if hits.size:
+            return start + hits[0]
+        start += window
+        window *= 2
+    return arr.shape[0]
+
+def _iter_mmap_chunks(fin, offset, approx_bytes=LST_FILE_APPROX_CHUNK):
+    """
+    Yields zero-copy (n, 2) views of the list data starting at byte offset, cut in front of
+    timer words like _read_binary_chunk, together with the file position after each chunk.
+    """
+    n_words = (os.path.getsize(fin) - offset)//4
+    if n_words <= 0:
+        return
+    arr = np.memmap(fin, dtype="<u2", mode="r", offset=offset, shape=(n_words, 2)).view(np.ndarray)
+    step = max(approx_bytes//4, 1)
+    start = 0
+    while start < n_words:
+        stop = _next_timer_index(arr, start + step)
+        yield arr[start:stop], offset + 4*stop
+        start = stop
+
+def _split_at_last_timer(bts):
+    """
+    Splits list data in front of its last timer word, since the block starting there may not
+    have been written completely yet. Returns the complete part and the remainder.
+    """
+    arr = np.frombuffer(bts, dtype="<u2", count=len(bts)//4*2).reshape(-1, 2)
+    idx = np.flatnonzero(arr[1:, 1] == TIMER_FLAG)
+    if idx.size == 0:
+        return b"", bts
+    cut = 4*(idx[-1] + 1)
+    return bts[:cut], bts[cut:]
+
+def _iter_stream_chunks(f, approx_bytes=LST_FILE_APPROX_CHUNK):
+    """
+    Like _iter_read_chunks, but reads f strictly sequentially so it also works for decompressing
+    streams: the block behind the last timer word of every read is carried over to the next
+    chunk instead of seeking back. The positions are offsets in the (decompressed) list file.
+    """
+    pos = f.tell()
+    pending = b""
+    while True:
+        bts = f.read(approx_bytes)
+        if not bts:
+            break
+        complete, pending = _split_at_last_timer(pending + bts)
+        if complete:
+            pos += len(complete)
+            yield _array_from_binary_chunk(complete), pos
+    if len(pending) >= 4:
+        pending = pending[:len(pending)//4*4]
+        pos += len(pending)
+        yield _array_from_binary_chunk(pending), pos
+
+def is_compressed(fin):
+    return os.path.splitext(fin)[1] in COMPRESSED_SUFFIXES
+
+def strip_compression_suffix(fin):
+    return os.path.splitext(fin)[0] if is_compressed(fin) else fin
+
+def _open_list_file(fin):
+    """
+    Opens fin for reading, compressed files are decompressed on the fly. Returns the list data
+    stream and the underlying file, whose position tells how much of fin has been read.
+    """
+    raw = open(fin, mode="rb")
+    suffix = os.path.splitext(fin)[1]
+    if suffix == ".gz":
+        return gzip.GzipFile(fileobj=raw), raw
+    if suffix == ".bz2":
+        return bz2.BZ2File(raw), raw
+    if suffix == ".xz":
+        return lzma.LZMAFile(raw), raw
+    if suffix == ".zst":
+        if zstandard is None:
+            raw.close()
+            sys.exit("Reading .zst list files requires the zstandard package.")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw)), raw
+    return raw, raw
+
+def _seek_forward(f, offset):
+    if f.seekable():
+        f.seek(offset)
+        return
+    while f.tell() < offset: # Decompress and drop everything up to offset
+        if not f.read(min(offset - f.tell(), LST_FILE_APPROX_CHUNK)):
+            break
+
+def _iter_chunks(fin, f, reader="mmap", approx_bytes=LST_FILE_APPROX_CHUNK):
+    """Chunk iterator for the list data of fin, f must be positioned after the header."""
+    if reader == "stream" or is_compressed(fin):
+        return _iter_stream_chunks(f, approx_bytes)
+    if reader == "mmap":
+        return _iter_mmap_chunks(fin, f.tell(), approx_bytes)
+    if reader == "read":
+        return _iter_read_chunks(f, os.path.getsize(fin), approx_bytes)
+    raise ValueError(f"Unknown reader '{reader}'.")
+
+def _map_ordered(fn, iterable, workers=1):
+    """
+    Like map(fn, iterable), but with up to workers calls in flight on a thread pool.
+    Results are yielded in order, the number of pending results is bounded.
+    """
+    if workers <= 1:
+        yield from map(fn, iterable)
+        return
+    with ThreadPoolExecutor(workers) as ex:
+        pending = deque()
+        for item in iterable:
+            pending.append(ex.submit(fn, item))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _segment_size(workers):
+    # Keep the amount of list data in flight roughly independent of the number of workers
+    return max(LST_FILE_APPROX_CHUNK//max(workers, 1), 1_000_000)
+
+@nb.njit(cache=True, nogil=True)
 def _extract_event_data(a):
-    # estim_sync = _estimate_syncflag_count(a)
+    out_event_id = np.zeros(a.size, dtype=np.uint32)
+    out_time = np.zeros(a.size, dtype=np.uint32)
+    out_value = np.zeros(a.size, dtype=np.uint16)
+    out_channel = np.zeros(a.size, dtype=np.uint8)
+    l, n_timer = _extract_event_data_into(a, out_event_id, out_time, out_channel, out_value)
+    return out_event_id[:l], out_time[:l], out_channel[:l], out_value[:l], n_timer
+
+@nb.njit(cache=True, nogil=True)
+def _extract_event_data_into(a, out_event_id, out_time, out_channel, out_value):
     n_timer = 0
     n_sync = 0
     n_event = 0
     k = 0
     l = 0
-    out_event_id = np.zeros(a.size, dtype=np.uint32)
-    out_time = np.zeros(a.size, dtype=np.uint32)
-    out_value = np.zeros(a.size, dtype=np.uint16)
-    out_channel = np.zeros(a.size, dtype=np.uint8)
     while True:
         if k >= a.shape[0]:
             break
@@ -156,12 +424,15 @@ def _extract_event_data(a):
                 for i in range(16):
                     n_data += (adc_has_data>>i) & 0x01
                 n_bytes = n_data + dummy_bit + 3*rtc_bit
-                adc_data = a[k:k+n_bytes//2].flatten()[dummy_bit + 3*rtc_bit:]
+                if k + n_bytes//2 > a.shape[0]: # Truncated event
+                    k = a.shape[0]
+                    break
+                w = 2*k + dummy_bit + 3*rtc_bit # position of the first value in 16 bit words
                 c = 0
                 for i in range(16):
                     if (adc_has_data >> i) & 0x01:
                         out_time[l] = n_timer
-                        out_value[l] = adc_data[c]
+                        out_value[l] = a[(w + c)//2, (w + c)%2]
                         out_channel[l] = i + 1  #Index ADCs starting with 1
                         out_event_id[l] = n_event
                         l += 1
@@ -172,16 +443,120 @@ def _extract_event_data(a):
                 k += n_bytes//2
         else: # Something is fishy, just press on
             k+=1
-    return out_event_id[:l], out_time[:l], out_channel[:l], out_value[:l]
+    return l, n_timer
+
+@nb.njit(cache=True, nogil=True)
+def _extract_event_columns(a, out_time, out_columns):
+    # Decodes straight into one column per ADC (rows of out_columns), adc_has_data tells where
+    # each value goes. The buffers need room for all events in a and the rows of all ADCs with
+    # data have to be prefilled with INVALID_ADC_VALUE, see _count_event_data.
+    n_timer = 0
+    n_event = 0
+    k = 0
+    while True:
+        if k >= a.shape[0]:
+            break
+        r = a[k]
+
+        if r[1] == 0x4000:
+            n_timer += 1
+            k += 1
+
+        elif np.all(r == SYNCFLAG):
+            k += 1
+            while True:
+                if k >= a.shape[0]:
+                    break
+
+                adc_has_data = a[k, 0]
+                if adc_has_data == 0:
+                    k += 1
+                    continue
+                event_flags = a[k, 1]
+                event_bit = (event_flags>>14) & 0x01 # bit 30 of double word, SHOULD BE 0
+                dummy_bit = (event_flags>>15) & 0x01 # bit 31 of double word
+                rtc_bit   = (event_flags>>12) & 0x01 # bit 28 of double word
+                if event_bit:
+                    break
+                k += 1
+
+                n_data = 0
+                for i in range(16):
+                    n_data += (adc_has_data>>i) & 0x01
+                n_bytes = n_data + dummy_bit + 3*rtc_bit
+                if k + n_bytes//2 > a.shape[0]: # Truncated event
+                    k = a.shape[0]
+                    break
+                w = 2*k + dummy_bit + 3*rtc_bit # position of the first value in 16 bit words
+                c = 0
+                for i in range(16):
+                    if (adc_has_data >> i) & 0x01:
+                        out_columns[i, n_event] = a[(w + c)//2, (w + c)%2]
+                        c += 1
+                    if c == n_data:
+                        break
+                out_time[n_event] = n_timer
+                n_event += 1
+                k += n_bytes//2
+        else: # Something is fishy, just press on
+            k+=1
+    return n_event, n_timer
+
+@nb.njit(cache=True, nogil=True)
+def _count_event_data(a):
+    # Cheap pass mirroring the event loop of the decoders, returns the number of events and
+    # a bitmask of the ADCs with data
+    n_event = 0
+    adc_mask = 0
+    k = 0
+    while True:
+        if k >= a.shape[0]:
+            break
+        r = a[k]
+
+        if r[1] == 0x4000:
+            k += 1
+
+        elif np.all(r == SYNCFLAG):
+            k += 1
+            while True:
+                if k >= a.shape[0]:
+                    break
+
+                adc_has_data = a[k, 0]
+                if adc_has_data == 0:
+                    k += 1
+                    continue
+                event_flags = a[k, 1]
+                event_bit = (event_flags>>14) & 0x01
+                dummy_bit = (event_flags>>15) & 0x01
+                rtc_bit   = (event_flags>>12) & 0x01
+                if event_bit:
+                    break
+                k += 1
+
+                n_data = 0
+                for i in range(16):
+                    n_data += (adc_has_data>>i) & 0x01
+                n_bytes = n_data + dummy_bit + 3*rtc_bit
+                if k + n_bytes//2 > a.shape[0]:
+                    k = a.shape[0]
+                    break
+                n_event += 1
+                adc_mask |= adc_has_data
+                k += n_bytes//2
+        else:
+            k+=1
+    return n_event, adc_mask
 
-@nb.njit(cache=True)
+@nb.njit(cache=True, nogil=True)
 def _assemble_output_array(event_id, time, channel, value):
     adcs = np.unique(channel)
     _col = {}
     for k in range(adcs.size):
         _col[adcs[k]] = k
     n_events = np.unique(event_id).size
-    out_time = np.zeros(n_events, dtype=np.int32)
+    out_time = np.zeros(n_events, dtype=np.uint32)
     out_value = np.zeros((n_events, adcs.size), dtype=np.uint16)
     out_value[:] = INVALID_ADC_VALUE
     id0 = event_id[0]
@@ -191,7 +566,7 @@ def _assemble_output_array(event_id, time, channel, value):
         out_value[e_id, _col[channel[k]]] = value[k]
     return adcs, out_time, out_value
 
-@nb.njit(cache=True)
+@nb.njit(cache=True, nogil=True)
 def _explore_event_data(a):
     # estim_sync = _estimate_syncflag_count(a)
     n_timer = 0
@@ -238,32 +613,33 @@ def _explore_event_data(a):
             k+=1
     return n_timer, n_sync, n_event, adc_has_data_total
 
-def explore_list_file(fin):
+def _explore_chunk(chunk):
+    arr, pos = chunk
+    return _explore_event_data(arr), pos
+
+def explore_list_file(fin, reader="mmap", workers=1, progress=True):
     n_timer = 0
     n_sync = 0
     n_event = 0
     adc_has_data = 0x00
     filesize = os.path.getsize(fin)
-    with open(fin, mode="rb") as f: #Prerun for exploration purposes
+    f, raw = _open_list_file(fin)
+    with raw, f: #Prerun for exploration purposes
         header = _read_header(f)
-        tq = tqdm(total=filesize, unit="B", desc="Analysis")
-        curs = f.tell()
+        tq = tqdm(total=filesize, unit="B", desc="Analysis", disable=not progress)
+        curs = raw.tell()
         tq.update(curs)
-        while True:
-            chnk = _read_binary_chunk(f, filesize)
-            tq.update(f.tell()-curs)
-            curs = f.tell()
-            arr = _array_from_binary_chunk(chnk)
+        chunks = _iter_chunks(fin, f, reader, _segment_size(workers))
+        for explored, pos in _map_ordered(_explore_chunk, chunks, workers):
+            pos = pos if f is raw else raw.tell() # Progress through compressed files
+            tq.update(pos-curs)
+            curs = pos
 
-            _n_timer, _n_sync, _n_event, _adc_has_data =  _explore_event_data(arr)
+            _n_timer, _n_sync, _n_event, _adc_has_data = explored
             n_timer += _n_timer
             n_sync += _n_sync
             n_event += _n_event
             adc_has_data = adc_has_data | _adc_has_data
-
-            exhausted = f.tell() == filesize
-            if exhausted:
-                break
         tq.close()
     relevant_adcs = []
     for k in range(16):
@@ -276,50 +652,496 @@ def explore_list_file(fin):
         "relevant_adcs":relevant_adcs
     }
 
-def convert(fin, fout):
-    explore = explore_list_file(fin)
+class _EventWriter:
+    """
+    Appends assembled events to the datasets of the EVENTS group.
+
+    If the number of events is not known in advance the datasets are created chunked and
+    resizable, they grow geometrically (or exactly to the appended length) and are trimmed to
+    the written length by finalize(). ADC columns that have not been announced are created
+    once the channel first shows up, earlier events read as INVALID_ADC_VALUE through the fill
+    value. After freeze() no datasets are created anymore, as required by SWMR, and data of
+    unannounced channels is dropped. The layout holds the chunking and filter arguments for
+    create_dataset, see _common.event_layout. With resume_at the existing datasets of h5events
+    are continued after their first resume_at events.
+    """
+    def __init__(self, h5events, n_event=None, adcs=(), exact=False, layout=None, resume_at=None):
+        self.h5events = h5events
+        self.layout = event_layout() if layout is None else layout
+        self.exact = exact
+        self.frozen = False
+        self.dropped = set()
+        if resume_at is not None:
+            self.resizable = h5events["TIME"].maxshape[0] is None
+            self.size = h5events["TIME"].len()
+            self.pos = resume_at
+            if self.resizable: # Cut off whatever was written after the checkpoint
+                self.size = resume_at
+                self._resize(self.size, list(event_columns(h5events)))
+            return
+        self.resizable = n_event is None
+        self.size = n_event or 0
+        self.pos = 0
+        self._create("TIME", np.uint32, 0)
+        for n in adcs:
+            self._create(f"ADC{n}", np.uint16, INVALID_ADC_VALUE)
+
+    def _create(self, name, dtype, fillvalue):
+        layout = self.layout
+        maxshape = (None,) if self.resizable else None
+        if not self.resizable and self.size < layout["chunks"][0]: # Chunks can't exceed fixed sizes
+            layout = dict(layout, chunks=(self.size,)) if self.size else {}
+        self.h5events.create_dataset(
+            name, shape=(self.size,), maxshape=maxshape, dtype=dtype, fillvalue=fillvalue, **layout
+        )
+
+    def _resize(self, size, names):
+        for name in names:
+            self.h5events[name].resize(size, axis=0)
+
+    def freeze(self):
+        self.frozen = True
+
+    def append(self, time, columns):
+        stop = self.pos + time.size
+        grow = stop > self.size
+        if grow:
+            self.size = stop if self.exact else max(stop, 2*self.size)
+            self._resize(self.size, [name for name in event_columns(self.h5events) if name != "TIME"])
+        sel = np.s_[self.pos:stop]
+        # TIME is written last, concurrent readers can take its length as the number of
+        # complete events
+        for name, column in columns.items():
+            if name not in self.h5events:
+                if self.frozen:
+                    if name not in self.dropped:
+                        tqdm.write(f"Dropping data of unannounced channel {name}.")
+                        self.dropped.add(name)
+                    continue
+                self._create(name, np.uint16, INVALID_ADC_VALUE)
+            self.h5events[name].write_direct(np.ascontiguousarray(column), dest_sel=sel)
+        if grow:
+            self._resize(self.size, ["TIME"])
+        self.h5events["TIME"].write_direct(np.ascontiguousarray(time), dest_sel=sel)
+        self.pos = stop
+
+    def flush(self):
+        for ds in event_columns(self.h5events).values():
+            ds.flush()
+
+    def finalize(self):
+        if self.resizable and self.size != self.pos:
+            self.size = self.pos
+            self._resize(self.size, list(event_columns(self.h5events)))
+
+class _CompactEventWriter:
+    """
+    Appends events to the EVENTS group with the compact codec of the events module. Events are
+    staged until a block is complete, finalize() writes the last, partial block and the block
+    tables. Columns that first show up later get empty blocks for the events before.
+    """
+    def __init__(self, h5events, block=COMPACT_BLOCK):
+        self.h5events = h5events
+        self.block = block
+        self.pos = 0
+        self.n_block = 0
+        self.staged = 0
+        self.time = np.empty(block, dtype=np.uint32)
+        self.columns = {}
+        self.data = {}
+        self.tables = {}
+        self.out = np.empty(encode_buffer_size(block), dtype=np.uint8)
+        h5events.attrs["codec"] = "compact"
+        h5events.attrs["block_events"] = block
+        h5events.attrs["n_event"] = 0
+        self._create("TIME")
+
+    def _create(self, name):
+        grp = self.h5events.create_group(name)
+        self.data[name] = grp.create_dataset(
+            "DATA", shape=(0,), maxshape=(None,), dtype=np.uint8, chunks=(1 << 20,)
+        )
+        self.tables[name] = [(0, 0, 0)]*self.n_block # Empty blocks before the column showed up
+
+    def _write_block(self):
+        staged = {"TIME":self.time[:self.staged]}
+        staged.update((name, column[:self.staged]) for name, column in self.columns.items())
+        for name, values in staged.items():
+            n_bytes, width, base = encode_block(name, values, self.out)
+            data = self.data[name]
+            offset = data.shape[0]
+            if n_bytes:
+                data.resize(offset + n_bytes, axis=0)
+                data.write_direct(self.out, np.s_[:n_bytes], np.s_[offset:offset + n_bytes])
+            self.tables[name].append((offset, width, base))
+        for column in self.columns.values():
+            column[:self.staged] = INVALID_ADC_VALUE
+        self.n_block += 1
+        self.staged = 0
+
+    def append(self, time, columns):
+        n = time.size
+        i = 0
+        while i < n:
+            m = min(n - i, self.block - self.staged)
+            sel = np.s_[self.staged:self.staged + m]
+            self.time[sel] = time[i:i + m]
+            for name, column in columns.items():
+                if name not in self.columns:
+                    self._create(name)
+                    self.columns[name] = np.full(self.block, INVALID_ADC_VALUE, dtype=np.uint16)
+                self.columns[name][sel] = column[i:i + m]
+            self.staged += m
+            i += m
+            if self.staged == self.block:
+                self._write_block()
+        self.pos += n
+
+    def flush(self):
+        self.h5events.file.flush()
+
+    def finalize(self):
+        if self.staged:
+            self._write_block()
+        for name, table in self.tables.items():
+            self.h5events[name].create_dataset(
+                "BLOCKS", data=np.array(table, dtype=np.int64).reshape(-1, 3)
+            )
+        self.h5events.attrs["n_event"] = self.pos
+
+def _write_header(o, header):
+    h5cfg = o.create_group("CFG")
+    for grpk, grp in header.items():
+        if not grpk in h5cfg.keys():
+            h5cfg.create_group(grpk)
+        for k, v in grp.items():
+            h5cfg[grpk].attrs[k] = v
+
+@nb.njit(cache=True, nogil=True)
+def _count_into(values, counts):
+    for i in range(values.size):
+        counts[values[i]] += 1
+
+class _RunSummary:
+    """
+    Statistics of the converted events, accumulated chunk by chunk and stored in EVENTS/SUMMARY:
+    the number of events per timer tick (RATE, indexed by TIME), the index of the first event at
+    or after every tick (TIME_INDEX, see events.time_window) and for every ADC a histogram
+    with one bin per value, carrying the number of values, their minimum and maximum and the
+    number of events without a value of the ADC as attributes.
+    """
+    def __init__(self):
+        self.n_event = 0
+        self.n_timer = 0
+        self.rate = np.zeros(1 << 16, dtype=np.uint32)
+        self.hists = {}
+
+    def update(self, time, columns, n_timer):
+        """Add the events of a chunk, n_timer is the number of timer ticks up to its end."""
+        if n_timer >= self.rate.size:
+            rate = np.zeros(max(n_timer + 1, 2*self.rate.size), dtype=np.uint32)
+            rate[:self.rate.size] = self.rate
+            self.rate = rate
+        _count_into(time, self.rate)
+        for name, column in columns.items():
+            if name not in self.hists:
+                self.hists[name] = np.zeros(INVALID_ADC_VALUE + 1, dtype=np.int64)
+            _count_into(column, self.hists[name])
+        self.n_event += time.size
+        self.n_timer = n_timer
+
+    def update_from(self, h5events, n_event, n_timer):
+        """Catch up on the first n_event events of h5events, e.g. when resuming a conversion."""
+        columns = {name:ds for name, ds in event_columns(h5events).items() if name != "TIME"}
+        for k in range(0, n_event, TYPICAL_DASK_CHUNK):
+            slc = np.s_[k:min(k + TYPICAL_DASK_CHUNK, n_event)]
+            self.update(
+                h5events["TIME"][slc], {name:ds[slc] for name, ds in columns.items()}, n_timer
+            )
+        self.n_timer = n_timer
+
+    def write(self, h5events):
+        if "SUMMARY" in h5events: # Left over from an interrupted conversion
+            del h5events["SUMMARY"]
+        grp = h5events.create_group("SUMMARY")
+        grp.attrs["n_event"] = self.n_event
+        grp.attrs["n_timer"] = self.n_timer
+        rate = self.rate[:self.n_timer + 1]
+        grp.create_dataset("RATE", data=rate, compression="gzip", shuffle=True)
+        index = np.concatenate(([0], np.cumsum(rate, dtype=np.uint64)))
+        grp.create_dataset("TIME_INDEX", data=index, compression="gzip", shuffle=True)
+        ticks = np.flatnonzero(rate)
+        if ticks.size:
+            grp.attrs["first_time"] = ticks[0]
+            grp.attrs["last_time"] = ticks[-1]
+        for name in column_names(h5events):
+            if name == "TIME":
+                continue
+            hist = self.hists.get(name, np.zeros(INVALID_ADC_VALUE + 1, dtype=np.int64))
+            values = np.flatnonzero(hist[:INVALID_ADC_VALUE])
+            count = hist[:INVALID_ADC_VALUE].sum()
+            ds = grp.create_dataset(
+                name, data=hist[:values[-1] + 1 if values.size else 0], compression="gzip", shuffle=True
+            )
+            ds.attrs["count"] = count
+            ds.attrs["n_invalid"] = self.n_event - count
+            if values.size:
+                ds.attrs["min"] = values[0]
+                ds.attrs["max"] = values[-1]
+
+class _ChunkBuffers:
+    """
+    Reusable output buffers for decoding list data chunks. They are sized by _count_event_data
+    and only grow (geometrically, by a quarter) if a chunk needs more room than any chunk
+    before, so the memory needed for decoding settles at a small multiple of the chunk size.
+    """
+    def __init__(self):
+        self.time = np.empty(0, dtype=np.uint32)
+        self.columns = np.empty((16, 0), dtype=np.uint16) # One row per ADC, untouched rows cost no memory
+
+    def reserve(self, n_event):
+        if n_event > self.time.size:
+            n = max(n_event, self.time.size + self.time.size//4)
+            self.time = np.empty(n, dtype=np.uint32)
+            self.columns = np.empty((16, n), dtype=np.uint16)
+
+def _buffer_pool(workers):
+    # Every segment in flight in _map_ordered plus the one being written holds a set of buffers
+    pool = LifoQueue() # Reuse the most recently returned buffers first
+    for _ in range(max(workers, 1) + 2):
+        pool.put(_ChunkBuffers())
+    return pool
+
+def _decode_chunk(pool, chunk):
+    arr, pos = chunk
+    bufs = pool.get()
+    n_event, adc_mask = _count_event_data(arr)
+    bufs.reserve(n_event)
+    for i in range(16):
+        if (adc_mask >> i) & 0x01:
+            bufs.columns[i, :n_event] = INVALID_ADC_VALUE
+    n_event, n_timer = _extract_event_columns(arr, bufs.time, bufs.columns)
+    return bufs, n_event, adc_mask, n_timer, pos
+
+def _append_decoded(writer, pool, decoded, n_timer, accumulators=(), summary=None):
+    """
+    Writes a decoded chunk (if there is a writer) and feeds it to the histogram accumulators
+    and the summary. Returns the buffers to the pool and the updated timer count.
+    """
+    bufs, n_event, adc_mask, _n_timer, _ = decoded
+    time = bufs.time[:n_event]
+    columns = {}
+    if n_event > 0:
+        time += n_timer
+        columns = {
+            f"ADC{i + 1}":bufs.columns[i, :n_event] for i in range(16) if (adc_mask >> i) & 0x01
+        }
+        if writer is not None:
+            writer.append(time, columns)
+        for acc in accumulators:
+            acc.update(columns, n_event)
+    if summary is not None:
+        summary.update(time, columns, n_timer + _n_timer)
+    pool.put(bufs)
+    return n_timer + _n_timer
+
+def _write_hists(fout, accumulators):
+    base = os.path.splitext(fout)[0]
+    for acc in accumulators:
+        if not acc.seen:
+            channels = ":".join(c for c in (acc.xchannel, acc.ychannel) if c)
+            tqdm.write(f"No data for the {channels} histogram, skipped.")
+            continue
+        write_h5hist(
+            hist_file_name(base, acc.xchannel, acc.ychannel), acc.counts, acc.ex, acc.ey,
+            xchannel=acc.xchannel, ychannel=acc.ychannel,
+            datafile=os.path.basename(fout), basefile=os.path.basename(fout)
+        )
+
+def _checkpoint(o, writer, offset, n_timer, complete=False):
+    """
+    Records in the attributes of EVENTS how far the conversion got: the byte offset in the list
+    file up to which all events are written, the id of the last written event and the timer
+    count at the offset. Everything written before is flushed first, so the checkpoint never
+    points past data that is not on disk yet.
+    """
+    o.flush()
+    attrs = writer.h5events.attrs
+    attrs["offset"] = offset
+    attrs["last_event_id"] = writer.pos - 1
+    attrs["last_time"] = n_timer
+    attrs["complete"] = complete
+    o.flush()
+
+def read_checkpoint(fout):
+    """The checkpoint recorded by convert in fout, None if there is none or fout is unreadable."""
+    if not os.path.exists(fout):
+        return None
+    try:
+        o = h5py.File(fout, mode="r")
+    except OSError:
+        return None
+    with o:
+        if "EVENTS" not in o or "offset" not in o["EVENTS"].attrs:
+            return None
+        attrs = o["EVENTS"].attrs
+        return {
+            "offset":int(attrs["offset"]),
+            "last_event_id":int(attrs["last_event_id"]),
+            "last_time":int(attrs["last_time"]),
+            "complete":bool(attrs["complete"]),
+        }
+
+def convert(fin, fout, single_pass=True, reader="mmap", workers=1, layout=None,
+            hists=(), write_events=True, progress=True, resume=False, checkpoint_interval=60.,
+            compact=False):
+    """
+    Convert the list file fin into the HDF5 file fout, compressed list files are decompressed
+    on the fly (see COMPRESSED_SUFFIXES). hists holds specifications
+    (xchannel, ychannel, nx, ny) of histograms to accumulate on the way, they are written next
+    to fout. With write_events=False only the histograms are written. With compact=True the
+    events are stored with the compact codec of the events module instead of plain datasets.
+
+    The progress is checkpointed in fout every checkpoint_interval seconds, the attribute
+    complete of EVENTS is only set once the conversion has finished and the run statistics
+    have been written to EVENTS/SUMMARY. With resume=True an interrupted conversion continues
+    from the checkpoint in fout, if there is one. Compact conversions stage partial blocks in
+    memory and are not checkpointed on the way, they start over instead.
+    """
+    checkpoint = read_checkpoint(fout) if resume and write_events else None
+    if checkpoint is not None and checkpoint["complete"]:
+        return
+    if single_pass or checkpoint is not None:
+        n_event, relevant_adcs = None, ()
+    else:
+        explore = explore_list_file(fin, reader, workers, progress)
+        n_event, relevant_adcs = explore["n_event"], explore["relevant_adcs"]
     filesize = os.path.getsize(fin)
-    with open(fin, mode="rb") as f, h5py.File(fout, mode="w") as o:
+    if not write_events:
+        output = nullcontext()
+    else:
+        output = h5py.File(fout, mode="w" if checkpoint is None else "r+")
+    f, raw = _open_list_file(fin)
+    with raw, f, output as o:
         header = _parse_header(f)
-        h5cfg = o.create_group("CFG")
-        for grpk, grp in header.items():
-            if not grpk in h5cfg.keys():
-                h5cfg.create_group(grpk)
-            for k, v in grp.items():
-                h5cfg[grpk].attrs[k] = v
-
-        h5events = o.create_group("EVENTS")
-        h5events.create_dataset("TIME", shape=(explore["n_event"],), dtype=np.uint32)
-        for n in explore["relevant_adcs"]:
-            h5events.create_dataset(f"ADC{n}", shape=(explore["n_event"],), dtype=np.uint16)
-        tq = tqdm(total=filesize, unit="B", desc="Rewrite ")
-        curs = f.tell()
+        accumulators = [HistogramAccumulator(*spec, config=header) for spec in hists]
+        writer = None
+        summary = None
+        n_timer = 0 # Running sums over the segments give the offsets of the next one
+        if checkpoint is not None:
+            if checkpoint["offset"] < f.tell() or f is raw and checkpoint["offset"] > filesize:
+                raise ValueError(f"The checkpoint in '{fout}' does not match the list file '{fin}'.")
+            _seek_forward(f, checkpoint["offset"])
+            n_timer = checkpoint["last_time"]
+            writer = _EventWriter(
+                o["EVENTS"], layout=layout, resume_at=checkpoint["last_event_id"] + 1
+            )
+            summary = _RunSummary()
+            summary.update_from(writer.h5events, writer.pos, n_timer)
+        elif o is not None:
+            _write_header(o, header)
+            if compact:
+                writer = _CompactEventWriter(o.create_group("EVENTS"))
+            else:
+                writer = _EventWriter(
+                    o.create_group("EVENTS"), n_event=n_event, adcs=relevant_adcs, layout=layout
+                )
+            summary = _RunSummary()
+        checkpoints = writer is not None and not compact
+        if checkpoints:
+            _checkpoint(o, writer, f.tell(), n_timer)
+        last_checkpoint = monotonic()
+        tq = tqdm(total=filesize, unit="B", desc="Rewrite ", disable=not progress)
+        offset = f.tell()
+        curs = raw.tell()
         tq.update(curs)
-        last_time = 0
-        last_event_id = 0
-        while True:
-            chnk = _read_binary_chunk(f, filesize)
-            tq.update(f.tell()-curs)
-            curs = f.tell()
-            arr = _array_from_binary_chunk(chnk)
-
-            event_id, time, channel, value = _extract_event_data(arr)
-            if event_id.size > 0:
-                event_id += last_event_id
-                time += last_time
-
-                channel, time, value = _assemble_output_array(event_id, time, channel, value)
-                h5events["TIME"].write_direct(np.ascontiguousarray(time), dest_sel=np.s_[event_id[0]:event_id[-1]+1])
-                for n, c in enumerate(channel):
-                    h5events[f"ADC{c}"].write_direct(np.ascontiguousarray(value[:, n]), dest_sel=np.s_[event_id[0]:event_id[-1]+1])
-
-                last_event_id = event_id[-1]
-                last_time = time[-1]
-            exhausted = f.tell() == filesize
-            if exhausted:
-                break
+        pool = _buffer_pool(workers)
+        chunks = _iter_chunks(fin, f, reader, _segment_size(workers))
+        for decoded in _map_ordered(partial(_decode_chunk, pool), chunks, workers):
+            offset = decoded[-1]
+            pos = offset if f is raw else raw.tell() # Progress through compressed files
+            tq.update(pos-curs)
+            curs = pos
+
+            n_timer = _append_decoded(writer, pool, decoded, n_timer, accumulators, summary)
+            if checkpoints and monotonic() - last_checkpoint > checkpoint_interval:
+                _checkpoint(o, writer, offset, n_timer)
+                last_checkpoint = monotonic()
+        if writer is not None:
+            writer.finalize()
+            summary.write(writer.h5events)
+            _checkpoint(o, writer, offset, n_timer, complete=True)
         tq.close()
+    _write_hists(fout, accumulators)
 
+def _wait_for_listdata(fin, poll_interval=1., timeout=60.):
+    """Blocks until the header of fin has been written completely."""
+    start = monotonic()
+    while True:
+        with open(fin, mode="rb") as f:
+            while True:
+                ln = f.readline()
+                if not ln.endswith(b"\n"): # EOF, possibly in the middle of a line
+                    break
+                if ln.decode("utf-8", errors="replace").strip() == FLAG_LISTDATA:
+                    return
+        if monotonic() - start > timeout:
+            sys.exit(f"The list file '{fin}' did not receive a complete header in time.")
+        sleep(poll_interval)
+
+def _announced_adcs(header):
+    adcs = []
+    for k in range(1, 17):
+        section = header.get(f"ADC{k}")
+        if section is not None and section.get("active", 1):
+            adcs.append(k)
+    return adcs or list(range(1, 17))
+
+def follow(fin, fout, poll_interval=1., idle_timeout=60., layout=None):
+    """
+    Converts a list file that is still being recorded. New complete timer blocks are decoded
+    as they arrive and appended to the output, which is kept open in SWMR mode. Stops once the
+    file has not grown for idle_timeout seconds or on KeyboardInterrupt.
+    """
+    _wait_for_listdata(fin, poll_interval, idle_timeout)
+    with open(fin, mode="rb") as f, h5py.File(fout, mode="w", libver="latest") as o:
+        header = _parse_header(f)
+        _write_header(o, header)
+
+        writer = _EventWriter(
+            o.create_group("EVENTS"), adcs=_announced_adcs(header), exact=True, layout=layout
+        )
+        o.swmr_mode = True
+        writer.freeze()
+        tq = tqdm(unit="B", desc="Follow  ")
+        tq.update(f.tell())
+        n_timer = 0
+        pool = _buffer_pool(1)
+        pending = b""
+        last_growth = monotonic()
+        try:
+            while True:
+                bts = f.read(LST_FILE_APPROX_CHUNK)
+                if not bts:
+                    if monotonic() - last_growth > idle_timeout:
+                        break
+                    sleep(poll_interval)
+                    continue
+                last_growth = monotonic()
+                tq.update(len(bts))
+                complete, pending = _split_at_last_timer(pending + bts)
+                if complete:
+                    decoded = _decode_chunk(pool, (_array_from_binary_chunk(complete), None))
+                    n_timer = _append_decoded(writer, pool, decoded, n_timer)
+                    writer.flush()
+        except KeyboardInterrupt:
+            pass
+        # The acquisition has stopped, the last block is as complete as it is going to get
+        if len(pending) >= 4:
+            arr = _array_from_binary_chunk(pending[:len(pending)//4*4])
+            _append_decoded(writer, pool, _decode_chunk(pool, (arr, None)), n_timer)
+        writer.finalize()
+        tq.close()
 
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,232 @@
+"""
+Generate synthetic MPA-3 list files for testing and benchmarking lst2hdf5.
+"""
+import os
+import sys
+import argparse
+from contextlib import nullcontext
+
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from _common import (
+    INVALID_ADC_VALUE,
+    check_output,
+)
+
+ADC_RANGE = 8192
+TICKS_PER_BLOCK = 10_000
+TIMER_WORD = 0x4000
+SYNC_WORD = 0xffff
+DUMMY_BIT = 1 << 15
+RTC_BIT = 1 << 12
+
+
+def _parse_cli_args():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic MPA-3 list file with known content."
+    )
+    parser.add_argument(
+        "out",
+        help="Output list file.",
+        type=str,
+    )
+    parser.add_argument(
+        "--size",
+        help="Approximate size of the list data in MB.",
+        type=float,
+        default=100.,
+    )
+    parser.add_argument(
+        "--adcs",
+        help="ADCs with data, e.g. '1 2 3'.",
+        type=int,
+        nargs="+",
+        default=[1, 2, 3],
+    )
+    parser.add_argument(
+        "--occupancy",
+        help="Probability of each ADC (in the order of --adcs) to carry a value in an event.",
+        type=float,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--rate",
+        help="Mean number of events per timer tick.",
+        type=float,
+        default=50.,
+    )
+    parser.add_argument(
+        "--idle",
+        help="Fraction of timer ticks without any events.",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--rtc",
+        help="Fraction of events carrying a real time clock stamp.",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--pause",
+        help="Timer ticks without any events after every block of 10000 ticks.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the random number generator.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--truth",
+        help="Also write the expected conversion result to this HDF5 file.",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        help="Skip yes/no prompts. WARNING May overwrite existing files.",
+        action="store_true"
+    )
+    return parser.parse_args()
+
+def make_header(adcs):
+    lines = ["[MPA3A] ", "version=1", "cmline0=synthetic data generated by synth_lst"]
+    for n in range(1, 17):
+        lines += [f"[ADC{n}]", f"range={ADC_RANGE}", f"active={int(n in adcs)}"]
+    lines.append("[LISTDATA]")
+    return ("\r\n".join(lines) + "\r\n").encode("ASCII")
+
+def _values(rng, n):
+    # A few peaks on a flat background, roughly what the spectra look like
+    centers = rng.uniform(0.1, 0.9, 4)*ADC_RANGE
+    vals = rng.normal(centers[rng.integers(0, centers.size, n)], ADC_RANGE/100)
+    bkg = rng.random(n) < 0.3
+    vals[bkg] = rng.uniform(0, ADC_RANGE, bkg.sum())
+    return np.clip(vals, 0, ADC_RANGE - 1).astype(np.uint16)
+
+def make_block(rng, adcs, occupancy, rate, idle, rtc, n_ticks, tick0=0):
+    """
+    Generate the list data for n_ticks timer ticks. Returns the 16 bit words and the expected
+    event columns: TIME (number of timer words up to the event, counting from tick0) and one
+    column per ADC filled with INVALID_ADC_VALUE where the ADC has no value.
+    """
+    adcs = np.asarray(adcs)
+    n_per_tick = rng.poisson(rate, n_ticks)
+    n_per_tick[rng.random(n_ticks) < idle] = 0
+    n_event = n_per_tick.sum()
+    tick = np.repeat(np.arange(n_ticks), n_per_tick)
+
+    has = rng.random((n_event, adcs.size)) < np.asarray(occupancy)
+    empty = ~has.any(axis=1) # Every event has at least one value
+    has[empty, rng.integers(0, adcs.size, empty.sum())] = True
+    mask = (has << (adcs - 1)).sum(axis=1)
+    n_data = has.sum(axis=1)
+    has_rtc = rng.random(n_event) < rtc
+    dummy = (n_data + 3*has_rtc) % 2
+    ev_len = 2 + dummy + 3*has_rtc + n_data
+
+    # Every tick starts with a timer word, followed by a sync word if any events follow
+    prefix_len = 2 + 2*(n_per_tick > 0)
+    first_event = np.concatenate(([0], np.cumsum(n_per_tick)[:-1]))
+    seg_len = np.empty(n_ticks + n_event, dtype=np.int64)
+    prefix_pos = np.arange(n_ticks) + first_event
+    event_pos = tick + 1 + np.arange(n_event)
+    seg_len[prefix_pos] = prefix_len
+    seg_len[event_pos] = ev_len
+    offset = np.concatenate(([0], np.cumsum(seg_len)[:-1]))
+
+    words = np.zeros(seg_len.sum(), dtype="<u2")
+    p = offset[prefix_pos]
+    words[p] = (1 << (adcs - 1)).sum() # The lower half of timer words flags the active ADCs
+    words[p + 1] = TIMER_WORD
+    p = p[n_per_tick > 0]
+    words[p + 2] = SYNC_WORD
+    words[p + 3] = SYNC_WORD
+    # Events: ADC mask, flags, optional dummy and RTC words, then the values in ADC order
+    e = offset[event_pos]
+    words[e] = mask
+    words[e + 1] = DUMMY_BIT*dummy + RTC_BIT*has_rtc
+    r = e[has_rtc] + 2 + dummy[has_rtc]
+    words[r] = 1
+    words[r + 1] = 2
+    words[r + 2] = 3
+    values = _values(rng, has.sum())
+    first_value = e + 2 + dummy + 3*has_rtc
+    pos = np.repeat(first_value, n_data) + np.arange(values.size) - np.repeat(np.cumsum(n_data) - n_data, n_data)
+    words[pos] = values
+
+    columns = {}
+    rows, cols = np.nonzero(has)
+    for k, n in enumerate(adcs):
+        col = np.full(n_event, INVALID_ADC_VALUE, dtype=np.uint16)
+        sel = cols == k
+        col[rows[sel]] = values[sel]
+        columns[f"ADC{n}"] = col
+    columns["TIME"] = (tick + tick0 + 1).astype(np.uint32)
+    return words, columns
+
+def generate(fout, size=100e6, adcs=(1, 2, 3), occupancy=None, rate=50., idle=0.1, rtc=0.05,
+             seed=0, truth="", pause=0):
+    """
+    Write a synthetic list file of roughly size bytes of list data. If truth is given, the
+    expected EVENTS of the converted file are written there. pause timer ticks without events
+    follow every block of TICKS_PER_BLOCK ticks. Returns the number of events.
+    """
+    if occupancy is None:
+        occupancy = [0.9]*len(adcs)
+    rng = np.random.default_rng(seed)
+    n_event = 0
+    tick0 = 0
+    with open(fout, "wb") as f, (h5py.File(truth, "w") if truth else nullcontext()) as t:
+        f.write(make_header(adcs))
+        start = f.tell()
+        if truth:
+            events = t.create_group("EVENTS")
+            for name in ["TIME"] + [f"ADC{n}" for n in adcs]:
+                events.create_dataset(
+                    name, shape=(0,), maxshape=(None,), chunks=(TICKS_PER_BLOCK,),
+                    dtype=np.uint32 if name == "TIME" else np.uint16
+                )
+        tq = tqdm(total=int(size), unit="B", desc="Generate")
+        while f.tell() - start < size:
+            words, columns = make_block(rng, adcs, occupancy, rate, idle, rtc, TICKS_PER_BLOCK, tick0)
+            f.write(words.tobytes())
+            tq.update(words.nbytes)
+            tick0 += TICKS_PER_BLOCK
+            if pause:
+                words, _ = make_block(rng, adcs, occupancy, rate, 1., rtc, pause, tick0)
+                f.write(words.tobytes())
+                tq.update(words.nbytes)
+                tick0 += pause
+            if truth:
+                for name, col in columns.items():
+                    ds = events[name]
+                    ds.resize(n_event + col.size, axis=0)
+                    ds[n_event:] = col
+            n_event += columns["TIME"].size
+        tq.close()
+    return n_event
+
+def _main():
+    args = _parse_cli_args()
+    check_output(args.out, args.yes)
+    if args.truth:
+        check_output(args.truth, args.yes)
+    occupancy = args.occupancy or [0.9]*len(args.adcs)
+    if len(occupancy) != len(args.adcs):
+        sys.exit("Give one occupancy per ADC.")
+    n_event = generate(
+        args.out, args.size*1e6, args.adcs, occupancy, args.rate, args.idle, args.rtc,
+        args.seed, args.truth, args.pause
+    )
+    print(f"Wrote {n_event} events, {os.path.getsize(args.out)/1e6:.1f} MB to '{args.out}'.")
+    sys.exit(0)
+
+if __name__ == "__main__":
+    _main()